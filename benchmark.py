@@ -0,0 +1,432 @@
+# Benchmark harness for the AccessR subtools.
+#
+# Runs DoAccess0 (study area), DoAccess1 (overlay) and DoAccess2 (isochrones)
+# one after another (and, with --pipeline, DoPipeline) against a local
+# Rserve, outside the NMTK, using simple stand-ins for the NMTK job and
+# client.  Each subtool run is recorded with its runtime, the peak memory of
+# this process and the per-stage timings and memory from stages.py, and all
+# runs are written to a JSON file so that engine and tuning changes can be
+# compared.
+#
+# Scenarios are either the bundled sample data (StudyArea_Vector.geojson,
+# SampleRoads.geojson and SamplePoints.geojson at 300x300 cells, as built
+# by sample.data/prepare.sample.data.R) or synthetic study areas: a square of
+# NxN cells with a regular grid of roads and randomly placed points.
+#
+# Run it from this folder on the tool server, with Rserve running and the
+# NMTK server folder on PYTHONPATH (tasks.py imports the NMTK helpers):
+#
+#   python benchmark.py --sample
+#   python benchmark.py --sizes 300,1000,2000,4000 --points 1,10,100,500 \
+#                       --engines gdistance,scipy --output benchmark.json
+#   python benchmark.py --sizes 2000 --points 10 --pyramid 4:50,8:50,8:20
+#
+# Prepared cost networks are not cached between runs unless --cache is given,
+# so that every isochrone run includes building the network.  Coarse-to-fine
+# runs of the native engine (--pyramid FACTOR:RADIUS) are compared cell by
+# cell with the exact gdistance isochrones, and their errors are recorded.
+
+import os
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import threading
+import datetime
+import argparse
+
+import tasks
+import rpool
+import netcache
+import stages
+import exchange
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"static","AccessR")
+
+# Synthetic study areas are squares of NxN cells near the sample data
+ORIGIN       = (-77.06,38.80)   # south-west corner (longitude, latitude)
+CELL_DEGREES = 0.0001           # cell size (roughly 10 metres)
+ROAD_SPACING = 25               # cells between synthetic roads
+
+# Values used for the synthetic (and sample) layers, as in the sample configs
+STUDY_VALUE = 3
+ROAD_VALUE  = 6
+
+class BenchmarkClient(object):
+    "Stand-in for the NMTK client: keeps status messages rather than posting them"
+
+    def __init__(self):
+        self.messages = []
+        self.results  = None
+
+    def updateStatus(self,message):
+        self.messages.append(message)
+
+    def updateResults(self,**kwargs):
+        self.results = kwargs
+
+class BenchmarkJob(object):
+    "Stand-in for Config.Job, with the data files and parameters given directly"
+
+    def __init__(self,files,parameters,logger):
+        self.files      = files         # namespace -> file name
+        self.parameters = parameters    # namespace -> { element : value }
+        self.logger     = logger
+        self.failures   = []
+        self.scratch    = exchange.Scratch()
+        self.stages     = stages.StageLog(logger)
+        self.R          = None
+
+    def getParameters(self,namespace):
+        return self.parameters.get(namespace,{})
+
+    def datafile(self,namespace):
+        return self.files[namespace]    # KeyError (as the NMTK fails) if not supplied
+
+    def fail(self,msg):
+        self.failures.append(msg)
+
+SAMPLE_INTERVAL = 0.05         # seconds between memory samples during a run
+
+def childrenMB(pid):
+    "Current resident set size of the child processes of pid, in MB (0 if unavailable)"
+    pages = 0
+    try:
+        names = [ name for name in os.listdir("/proc") if name.isdigit() ]
+    except OSError:
+        return 0.0
+    for name in names:
+        try:
+            with open("/proc/%s/stat"%(name,)) as stat:
+                fields = stat.read().rsplit(")",1)[1].split()
+            if int(fields[1]) != pid:
+                continue
+            with open("/proc/%s/statm"%(name,)) as statm:
+                pages += int(statm.read().split()[1])
+        except (IOError,OSError,ValueError,IndexError):
+            pass                        # the child exited meanwhile
+    return pages*os.sysconf("SC_PAGE_SIZE")/(1024.0*1024.0)
+
+class MemorySampler(object):
+    """
+    Peak resident set size of this process and of its children (the native
+    engine's worker processes) during one run, sampled in a background
+    thread.  ru_maxrss would give the peak over the whole benchmark, so every
+    run after the largest would report the same figures.
+    """
+
+    def __init__(self,interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.own      = 0.0
+        self.children = 0.0
+        self.stopped  = threading.Event()
+        self.thread   = None
+
+    def sample(self):
+        self.own      = max(self.own,stages.residentMB())
+        self.children = max(self.children,childrenMB(os.getpid()))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run,name="benchmark-memory")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        return False
+
+    def peakMB(self):
+        "Peak resident set size of this process and of its children, in MB"
+        return round(self.own,1), round(self.children,1)
+
+def writeGeoJSON(filename,features):
+    "Write a WGS84 FeatureCollection like the bundled sample files"
+    collection = {
+        "type"     : "FeatureCollection",
+        "crs"      : { "type" : "name", "properties" : { "name" : "urn:ogc:def:crs:OGC:1.3:CRS84" } },
+        "features" : features,
+        }
+    f = file(filename,"w")
+    json.dump(collection,f)
+    f.close()
+
+def syntheticArea(n):
+    "Bounding box (west, south, east, north) of a synthetic NxN study area"
+    west, south = ORIGIN
+    return ( west, south, west+n*CELL_DEGREES, south+n*CELL_DEGREES )
+
+def writeStudyArea(filename,bbox):
+    west, south, east, north = bbox
+    ring = [ [west,south], [east,south], [east,north], [west,north], [west,south] ]
+    writeGeoJSON(filename,[ { "type" : "Feature", "id" : 1,
+                              "properties" : { "access" : STUDY_VALUE },
+                              "geometry" : { "type" : "Polygon", "coordinates" : [ ring ] } } ])
+
+def writeRoads(filename,bbox,n):
+    "A regular grid of roads, ROAD_SPACING cells apart"
+    west, south, east, north = bbox
+    features = []
+    for k in range(ROAD_SPACING/2,n,ROAD_SPACING):
+        offset = (k+0.5)*CELL_DEGREES
+        for line in ( [ [west,south+offset], [east,south+offset] ],
+                      [ [west+offset,south], [west+offset,north] ] ):
+            features.append({ "type" : "Feature", "id" : len(features),
+                              "properties" : { "access" : ROAD_VALUE },
+                              "geometry" : { "type" : "LineString", "coordinates" : line } })
+    writeGeoJSON(filename,features)
+
+def writePoints(filename,bbox,count,seed):
+    "count points placed at random (but reproducibly) inside the study area"
+    west, south, east, north = bbox
+    rng = random.Random(seed)
+    features = []
+    for i in range(count):
+        point = [ rng.uniform(west,east), rng.uniform(south,north) ]
+        features.append({ "type" : "Feature", "id" : i, "properties" : {},
+                          "geometry" : { "type" : "Point", "coordinates" : point } })
+    writeGeoJSON(filename,features)
+
+def outputPage(options,**elements):
+    "Output configuration page with the benchmark's GeoTIFF format settings"
+    page = { "datatype"    : options.datatype,
+             "compression" : options.compression,
+             "tiled"       : False,
+             "overviews"   : options.overviews }
+    page.update(elements)
+    return page
+
+def runSubtool(subtool,files,parameters,workdir,logger):
+    """
+    Run one subtool as performModel would, and return its record and the
+    name of its result file (moved into workdir so it survives clean-up).
+    """
+    job    = BenchmarkJob(files,parameters,logger)
+    client = BenchmarkClient()
+    pool   = rpool.getPool()
+    job.R  = pool.acquire()
+    memory = MemorySampler()
+    try:
+        job.stages.startR(job.R)
+        start   = time.time()
+        with memory:
+            results = tasks.doSubTool[subtool](job,client)
+        seconds = time.time()-start
+        job.stages.collectR(job.R)
+    finally:
+        pool.release(job.R)
+        job.R = None
+
+    for entry in results["files"].values():
+        entry[1].close()
+    handle = results["files"][results["result_file"]][1]
+    outputfile = os.path.join(workdir,"%s-%d.tif"%(subtool,int(time.time()*1000)))
+    shutil.move(handle.name,outputfile)
+    job.scratch.remove()
+
+    own, children = memory.peakMB()
+    record = {
+        "subtool"        : subtool,
+        "seconds"        : round(seconds,3),
+        "peak_rss_mb"    : own,         # this process (native engine, GDAL)
+        "peak_child_mb"  : children,    # native engine worker processes (all at once)
+        "peak_r_heap_mb" : max([ s["memory"] for s in job.stages.entries if s["source"] == "R" ] or [None]),
+        "output_bytes"   : os.path.getsize(outputfile),
+        "stages"         : job.stages.entries,
+        }
+    return record, outputfile
+
+def compareRasters(reference,result):
+    """
+    Accuracy of an approximate isochrone raster against a reference (exact)
+    one with the same grid: errors over the cells both reached, relative to
+    the reference cost, and the number of cells reached by only one of them.
+    """
+    import numpy
+    from osgeo import gdal
+
+    def read(filename):
+        ds = gdal.Open(filename)
+        bands = []
+        for b in range(1,ds.RasterCount+1):
+            band   = ds.GetRasterBand(b)
+            values = band.ReadAsArray().astype(numpy.float64)
+            nodata = band.GetNoDataValue()
+            if nodata is not None:
+                values[values==nodata] = numpy.nan
+            bands.append(values)
+        ds = None
+        return numpy.array(bands)
+
+    exact, approx = read(reference), read(result)
+    both  = ~numpy.isnan(exact) & ~numpy.isnan(approx)
+    error = (approx[both]-exact[both])/exact[both]
+    return {
+        "cells_compared"   : int(both.sum()),
+        "reach_mismatch"   : int((numpy.isnan(exact) != numpy.isnan(approx)).sum()),
+        "mean_rel_error"   : round(float(error.mean()),4) if error.size else None,
+        "mean_abs_rel_error" : round(float(numpy.abs(error).mean()),4) if error.size else None,
+        "max_abs_rel_error"  : round(float(numpy.abs(error).max()),4) if error.size else None,
+        }
+
+def pyramidSettings(text):
+    "Coarse-to-fine settings FACTOR:RADIUS, comma-separated (e.g. 4:50,8:20)"
+    settings = []
+    for item in text.split(","):
+        if item:
+            factor, radius = item.split(":")
+            settings.append((int(factor),float(radius)))
+    return settings
+
+def runScenario(scenario,n,areafile,roadfile,pointfiles,options,workdir,logger):
+    "Run Access0, Access1 and then Access2 (per engine and point file) for one study area"
+    records = []
+    def run(subtool,files,parameters,**details):
+        for repeat in range(options.repeat):
+            record, outputfile = runSubtool(subtool,files,parameters,workdir,logger)
+            record.update(details)
+            record.update({ "scenario" : scenario, "cells" : n*n, "repeat" : repeat })
+            records.append(record)
+            print "%-10s %-8s %9d cells %5s points %-10s %8.2fs" % \
+                  (scenario,subtool,n*n,details.get("points",""),details.get("engine",""),record["seconds"])
+        return outputfile
+
+    study_parameters = {
+        "rasterize"            : { "rastervalue" : STUDY_VALUE },
+        "rasterization_params" : { "raster_x" : n, "raster_y" : n,
+                                   "working_epsg" : 4326, "block_rows" : options.block_rows } }
+    overlay_parameters = {
+        "overlay"              : { "accessibility" : ROAD_VALUE },
+        "overlay_type"         : { "overlay_style" : "Facility" },
+        "processing_params"    : { "block_rows" : options.block_rows },
+        "accessibility_output" : outputPage(options,accessibilityfile="Accessibility",keep_crs=False) }
+    parameters = dict(study_parameters,studyarea_output=outputPage(options,studyareafile="StudyArea"))
+    studyarea = run("Access0",{ "rasterize" : areafile },parameters)
+    accessibility = run("Access1",{ "accessibility" : studyarea, "overlay" : roadfile },overlay_parameters)
+    for points, pointfile in pointfiles:
+        exact = {}
+        for engine in options.engines:
+            isochrones = {
+                "isochrone_params" : { "engine" : engine, "max_cost" : options.max_cost,
+                                       "workers" : options.workers, "block_rows" : options.block_rows },
+                "isochrone_output" : outputPage(options,isochronefile="Isochrone",
+                                                isochrone_layers=options.per_point) }
+            exact[engine] = run("Access2",{ "accessibility" : accessibility, "points" : pointfile },
+                                isochrones,engine=engine,points=points)
+            if options.pipeline:
+                parameters = dict(study_parameters)
+                parameters.update(overlay_parameters)
+                parameters.update(isochrones)
+                run("AccessPipeline",{ "rasterize" : areafile, "overlay" : roadfile, "points" : pointfile },
+                    parameters,engine=engine,points=points)
+        # Coarse-to-fine runs of the native engine, checked against the exact
+        # gdistance result (or the exact native one if gdistance was not run)
+        reference = exact.get("gdistance",exact.get("scipy"))
+        for factor, radius in options.pyramid:
+            isochrones = {
+                "isochrone_params" : { "engine" : "scipy", "max_cost" : options.max_cost,
+                                       "workers" : options.workers, "block_rows" : options.block_rows,
+                                       "exact_radius" : radius, "pyramid_factor" : factor },
+                "isochrone_output" : outputPage(options,isochronefile="Isochrone",
+                                                isochrone_layers=options.per_point) }
+            outputfile = run("Access2",{ "accessibility" : accessibility, "points" : pointfile },
+                             isochrones,engine="scipy",points=points,pyramid_factor=factor,exact_radius=radius)
+            if reference:
+                accuracy = compareRasters(reference,outputfile)
+                for record in records[-options.repeat:]:
+                    record["accuracy"] = accuracy
+                print "%-10s pyramid %d:%g against %s: mean error %+.1f%%, max %.1f%%" % \
+                      (scenario,factor,radius,"gdistance" if "gdistance" in exact else "scipy",
+                       100*(accuracy["mean_rel_error"] or 0),100*(accuracy["max_abs_rel_error"] or 0))
+    return records
+
+def numbers(text):
+    return [ int(value) for value in text.split(",") if value ]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the AccessR subtools against a local Rserve")
+    parser.add_argument("--sample",action="store_true",help="run the bundled sample data (300x300 cells)")
+    parser.add_argument("--sizes",type=numbers,default=[],help="synthetic study area sizes N (NxN cells), e.g. 300,1000,4000")
+    parser.add_argument("--points",type=numbers,default=[1,10,100],help="synthetic point counts, e.g. 1,10,100,500")
+    parser.add_argument("--engines",type=lambda text: text.split(","),default=["gdistance","scipy"])
+    parser.add_argument("--pipeline",action="store_true",help="also run the AccessPipeline subtool (all three steps in one job)")
+    parser.add_argument("--per-point",action="store_true",help="one isochrone band per point (default: Destinations only)")
+    parser.add_argument("--pyramid",type=pyramidSettings,default=[],
+                        help="coarse-to-fine native runs FACTOR:RADIUS to compare with the exact result, e.g. 4:50,8:20")
+    parser.add_argument("--workers",type=int,default=1)
+    parser.add_argument("--max-cost",type=float,default=0)
+    parser.add_argument("--block-rows",type=int,default=0)
+    parser.add_argument("--datatype",default="Float64")
+    parser.add_argument("--compression",default="None")
+    parser.add_argument("--overviews",action="store_true")
+    parser.add_argument("--repeat",type=int,default=1,help="runs of each subtool")
+    parser.add_argument("--seed",type=int,default=1)
+    parser.add_argument("--cache",action="store_true",help="let repeat runs reuse prepared networks")
+    parser.add_argument("--output",default="benchmark.json")
+    parser.add_argument("--keep",action="store_true",help="keep the generated and result files")
+    parser.add_argument("--verbose",action="store_true")
+    options = parser.parse_args(argv)
+    for engine in options.engines:
+        if engine not in tasks.IsochroneEngines:
+            parser.error("unknown isochrone engine: %s"%(engine,))
+    if not options.sample and not options.sizes:
+        options.sample = True
+
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.WARNING)
+    logger  = logging.getLogger("AccessR.benchmark")
+    workdir = tempfile.mkdtemp(prefix="accessr-bench-")
+    if options.cache:
+        netcache._cache = netcache.NetworkCache(directory=os.path.join(workdir,"cache"))
+    else:
+        netcache._cache = netcache.NetworkCache(memory_bytes=0,disk_bytes=0)
+
+    records = []
+    try:
+        if options.sample:
+            records += runScenario("sample",300,
+                                   os.path.join(SAMPLE_DIR,"StudyArea_Vector.geojson"),
+                                   os.path.join(SAMPLE_DIR,"SampleRoads.geojson"),
+                                   [ (3,os.path.join(SAMPLE_DIR,"SamplePoints.geojson")) ],
+                                   options,workdir,logger)
+        for n in options.sizes:
+            bbox     = syntheticArea(n)
+            areafile = os.path.join(workdir,"area-%d.geojson"%(n,))
+            roadfile = os.path.join(workdir,"roads-%d.geojson"%(n,))
+            writeStudyArea(areafile,bbox)
+            writeRoads(roadfile,bbox,n)
+            pointfiles = []
+            for count in options.points:
+                pointfile = os.path.join(workdir,"points-%d-%d.geojson"%(n,count))
+                writePoints(pointfile,bbox,count,options.seed)
+                pointfiles.append((count,pointfile))
+            records += runScenario("synthetic",n,areafile,roadfile,pointfiles,options,workdir,logger)
+    finally:
+        rpool.getPool().close()
+        report = {
+            "generated" : datetime.datetime.now().isoformat(),
+            "host"      : platform.node(),
+            "python"    : platform.python_version(),
+            "options"   : vars(options),
+            "runs"      : records,
+            }
+        f = file(options.output,"w")
+        json.dump(report,f,indent=2)
+        f.close()
+        print "Wrote %d runs to %s"%(len(records),options.output)
+        if options.keep:
+            print "Generated and result files kept in",workdir
+        else:
+            shutil.rmtree(workdir,ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# Isochrone contour polygons for the Access2 subtool.
+#
+# Most users of the isochrone raster only look at a few cost bands (say 5, 10
+# and 15 units), so the "Contours" output mode turns the isochrone raster
+# into polygons at a set of cost breaks instead of returning the raster:
+#
+#   - unless breaks are given, they are taken from the Destinations band:
+#     the quartiles of the costs of the cells reached, rounded up to three
+#     significant digits (costs depend on the units of the map, so a fixed
+#     default would fit almost no map);
+#   - each band (Destinations, and each point if per-point bands were made)
+#     is classified by the breaks: class k holds the cells that cost more
+#     than break k-1 (or 0) and no more than break k;
+#   - each class is polygonized with GDAL, dissolved into one MultiPolygon
+#     and simplified (preserving topology) to about half a cell;
+#   - the polygons are written as a GeoJSON FeatureCollection in the CRS of
+#     the raster (longitude/latitude, as the isochrone rasters are written).
+#
+# The result is a small fraction of the size of the raster and displays
+# much faster in the NMTK viewer.
+
+import json
+import numpy
+
+# Decimal places kept in the GeoJSON coordinates (about 1cm in degrees)
+COORDINATE_DIGITS = 7
+
+# Percentiles of the reached costs used as breaks when none are given
+DEFAULT_PERCENTILES = [ 25, 50, 75, 100 ]
+
+def parseBreaks(text):
+    "Cost breaks from a comma-separated string, in increasing order (None if empty)"
+    try:
+        breaks = sorted(set( float(value) for value in str(text or "").split(",") if value.strip() ))
+    except ValueError:
+        raise Exception("Contour breaks must be numbers separated by commas:",text)
+    if not breaks:
+        return None                     # taken from the data by writeIsochronePolygons
+    if breaks[0] <= 0:
+        raise Exception("Contour breaks must be one or more positive costs:",text)
+    if len(breaks) > 254:
+        raise Exception("Too many contour breaks (at most 254):",len(breaks))
+    return breaks
+
+def roundUp(value,digits=3):
+    "value rounded up to digits significant digits"
+    scale = 10.0**(digits-1-int(numpy.floor(numpy.log10(value))))
+    return float(numpy.ceil(value*scale-1e-9))/scale
+
+def defaultBreaks(values):
+    """
+    Cost breaks for a band of costs: the DEFAULT_PERCENTILES of the costs of
+    the cells reached, rounded up.  The last break covers every reached cell.
+    """
+    reached = values[numpy.isfinite(values)]
+    reached = reached[reached > 0]      # the origins themselves cost 0
+    if not reached.size:
+        return [ 1.0 ]                  # only the origins were reached
+    return sorted(set( roundUp(v) for v in numpy.percentile(reached,DEFAULT_PERCENTILES) ))
+
+def _round(coordinates):
+    "Round nested GeoJSON coordinate lists to COORDINATE_DIGITS"
+    if coordinates and isinstance(coordinates[0],list):
+        return [ _round(c) for c in coordinates ]
+    return [ round(c,COORDINATE_DIGITS) for c in coordinates ]
+
+def classify(values,breaks):
+    """
+    Contour class of each cell: k (from 1) if the cost is above break k-1
+    and no more than break k, 0 if it is NaN or beyond the last break.
+    """
+    classes = numpy.zeros(values.shape,dtype=numpy.uint8)
+    within  = numpy.isfinite(values)
+    within[within] = values[within] <= breaks[-1]
+    classes[within] = numpy.searchsorted(breaks,values[within],side="left") + 1
+    return classes
+
+def bandPolygons(classes,transform,projection,tolerance):
+    "Dissolved, simplified polygon (OGR geometry) for each class present"
+    from osgeo import gdal, ogr, osr
+    mem = gdal.GetDriverByName("MEM").Create("",classes.shape[1],classes.shape[0],1,gdal.GDT_Byte)
+    mem.SetGeoTransform(transform)
+    mem.SetProjection(projection)
+    band = mem.GetRasterBand(1)
+    band.WriteArray(classes)
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(projection)
+    source = ogr.GetDriverByName("Memory").CreateDataSource("")   # must outlive the layer
+    layer = source.CreateLayer("contours",srs,ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn("class",ogr.OFTInteger))
+    gdal.Polygonize(band,band,layer,0,[],callback=None)    # class 0 cells are masked out
+
+    dissolved = {}
+    for feature in layer:
+        k = feature.GetField("class")
+        if k not in dissolved:
+            dissolved[k] = ogr.Geometry(ogr.wkbMultiPolygon)
+        dissolved[k].AddGeometry(feature.GetGeometryRef())
+    source = None
+    mem = None
+    return dict( (k,geometry.SimplifyPreserveTopology(tolerance)) for k, geometry in dissolved.items() )
+
+def writeIsochronePolygons(rasterfile,outputfile,breaks=None,labels=None,tolerance=0):
+    """
+    Write contour polygons at the cost breaks (None to take them from the
+    Destinations band) for the Destinations band of an isochrone raster
+    (band 1) and, if the labels of the points (pointfile.PointSet.labels)
+    are given, for each point's band, as GeoJSON.  tolerance is the simplification distance in map units (0 for half a
+    cell).  Returns the number of polygons written and the breaks used;
+    raises an exception if no reached cell falls within the breaks.
+    """
+    from osgeo import gdal
+    ds = gdal.Open(rasterfile)
+    if ds is None:
+        raise Exception("Unable to read raster file: %s"%(rasterfile,))
+    transform  = ds.GetGeoTransform()
+    projection = ds.GetProjection()
+    if not tolerance:
+        tolerance = abs(transform[1])/2.0
+
+    features = []
+    for b in range(1,(len(labels) if labels else 0)+2):
+        band   = ds.GetRasterBand(b)
+        values = band.ReadAsArray().astype(numpy.float64)
+        nodata = band.GetNoDataValue()
+        if nodata is not None:
+            values[values==nodata] = numpy.nan
+        if b == 1:
+            reached = values[numpy.isfinite(values)]
+            if not reached.size:
+                raise Exception("No cell of the map was reached from the points")
+            if breaks is None:
+                breaks = defaultBreaks(values)
+            if reached.min() > breaks[-1]:
+                raise Exception("No cell falls within the contour breaks (at most %g); reached costs range from %g to %g"%(
+                                breaks[-1],reached.min(),reached.max()))
+        polygons = bandPolygons(classify(values,breaks),transform,projection,tolerance)
+        for k in sorted(polygons):
+            if polygons[k].IsEmpty():
+                continue
+            geometry = json.loads(polygons[k].ExportToJson())
+            geometry["coordinates"] = _round(geometry["coordinates"])
+            features.append({
+                "type"       : "Feature",
+                "id"         : len(features),
+                "properties" : {
+                    "band"     : "Destinations" if b == 1 else "Point %d"%(b-1,),
+                    "point"    : labels[b-2] if b > 1 else None,    # label of the point in the points file (feature id, ".k" for MultiPoint members)
+                    "min_cost" : breaks[k-2] if k > 1 else 0,
+                    "max_cost" : breaks[k-1],
+                    },
+                "geometry"   : geometry,
+                })
+    ds = None
+
+    collection = {
+        "type"     : "FeatureCollection",
+        "crs"      : { "type" : "name", "properties" : { "name" : "urn:ogc:def:crs:OGC:1.3:CRS84" } },
+        "features" : features,
+        }
+    f = open(outputfile,"w")
+    json.dump(collection,f)
+    f.close()
+    return len(features), breaks
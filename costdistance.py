@@ -0,0 +1,447 @@
+# Native cost-distance engine for the Access2 (isochrone) subtool.
+#
+# This reproduces the gdistance computation used in DoAccess2:
+#
+#     map.unit <- xres(r.raster)
+#     tr.matrix <- transition(r.raster,function(x) mean(x)*map.unit,8)
+#     geo.correct <- geoCorrection(tr.matrix,multpl=TRUE)
+#     cost.network <- geo.correct * tr.matrix
+#     accCost(cost.network,point)
+#
+# but builds the 8-neighbour network with vectorized NumPy array operations
+# and runs Dijkstra with scipy.sparse.csgraph, so isochrone jobs do not need
+# an Rserve process to do the heavy lifting.  Rasters are read and written
+# with the GDAL Python bindings that the NMTK already requires.
+#
+# As in gdistance, the conductance between two neighbouring cells is the
+# mean of their values scaled by the map unit, divided by the distance
+# between the cell centres (great-circle metres for longitude/latitude
+# rasters, map units otherwise).  NA cells are not part of the network,
+# and an edge between two zero-valued cells has no conductance at all.
+
+import numpy
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+from osgeo import gdal, osr
+import geotiff
+
+EARTH_RADIUS = 6378137.0        # same sphere that gdistance uses for geoCorrection
+SOURCE_COST  = 1e-300            # cost of the edges from the virtual source in accCost(min_only=True)
+
+# Neighbour offsets (row,column) for an 8-direction ("queen") network.  Only
+# half of the directions are listed; each edge is added in both directions.
+NEIGHBOURS = ( (0,1), (1,-1), (1,0), (1,1) )
+
+class Grid(object):
+    "Cell values and georeferencing for a single-band north-up raster"
+
+    def __init__(self,values,transform,projection):
+        self.values     = values            # 2-D float64 array, NaN for NA cells
+        self.transform  = tuple(transform)  # GDAL geotransform
+        self.projection = projection        # WKT
+
+    nrows = property(lambda self: self.values.shape[0])
+    ncols = property(lambda self: self.values.shape[1])
+    ncell = property(lambda self: self.values.size)
+    xres  = property(lambda self: abs(self.transform[1]))
+    yres  = property(lambda self: abs(self.transform[5]))
+
+    @property
+    def lonlat(self):
+        "True if the raster is in geographic (longitude/latitude) coordinates"
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(self.projection)
+        return bool(srs.IsGeographic())
+
+    def rowLatitudes(self):
+        "Latitude of the centre of each row (only meaningful for lonlat rasters)"
+        return self.transform[3] + (numpy.arange(self.nrows)+0.5)*self.transform[5]
+
+    def cellFromXY(self,x,y):
+        "Cell numbers (row-major, from 0) for coordinates; -1 for points off the raster"
+        x   = numpy.asarray(x,dtype=numpy.float64)
+        y   = numpy.asarray(y,dtype=numpy.float64)
+        col = numpy.floor((x-self.transform[0])/self.transform[1]).astype(numpy.int64)
+        row = numpy.floor((y-self.transform[3])/self.transform[5]).astype(numpy.int64)
+        inside = (col>=0) & (col<self.ncols) & (row>=0) & (row<self.nrows)
+        return numpy.where(inside,row*self.ncols+col,-1)
+
+    def transformPoints(self,lon,lat):
+        "Project longitude/latitude (EPSG:4326) coordinates into the raster CRS"
+        target = osr.SpatialReference()
+        target.ImportFromWkt(self.projection)
+        source = osr.SpatialReference()
+        source.ImportFromEPSG(4326)
+        if hasattr(source,"SetAxisMappingStrategy"): # GDAL 3: keep x=longitude, y=latitude
+            source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if source.IsSame(target):
+            return numpy.asarray(lon,dtype=numpy.float64), numpy.asarray(lat,dtype=numpy.float64)
+        ct = osr.CoordinateTransformation(source,target)
+        xy = numpy.array([ ct.TransformPoint(float(x),float(y))[:2] for x,y in zip(lon,lat) ])
+        return xy[:,0], xy[:,1]
+
+def readGrid(filename):
+    "Read the first band of a raster file into a Grid"
+    ds = gdal.Open(filename)
+    if ds is None:
+        raise Exception("Unable to read raster file: %s"%(filename,))
+    band   = ds.GetRasterBand(1)
+    values = band.ReadAsArray().astype(numpy.float64)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        values[values==nodata] = numpy.nan
+    grid = Grid(values,ds.GetGeoTransform(),ds.GetProjection())
+    ds = None
+    return grid
+
+def greatCircle(lat1,lat2,dlon):
+    "Haversine distance (metres) between points at two latitudes dlon degrees apart"
+    lat1 = numpy.radians(lat1)
+    lat2 = numpy.radians(lat2)
+    dlon = numpy.radians(dlon)
+    a = numpy.sin((lat2-lat1)/2.0)**2 + numpy.cos(lat1)*numpy.cos(lat2)*numpy.sin(dlon/2.0)**2
+    return 2.0*EARTH_RADIUS*numpy.arcsin(numpy.sqrt(numpy.minimum(a,1.0)))
+
+def costNetwork(grid,block_rows=None):
+    """
+    Build the geo-corrected cost network for a grid as a sparse matrix
+    whose entries are the cost of moving between neighbouring cells
+    (the reciprocal of the gdistance conductance).
+
+    The edges are worked out block_rows rows at a time (all at once if
+    block_rows is not given), which bounds the temporary arrays needed for
+    large grids to a few times the size of one block.
+    """
+    v        = grid.values
+    nrows    = grid.nrows
+    ncols    = grid.ncols
+    map_unit = grid.xres
+    index    = numpy.int32 if grid.ncell < 2**31 else numpy.int64
+    lats     = grid.rowLatitudes() if grid.lonlat else None
+    block    = int(block_rows) if block_rows else nrows
+
+    sources, targets, costs = [], [], []
+    for r0 in range(0,nrows,block):
+        r1 = min(r0+block,nrows)
+        for dr,dc in NEIGHBOURS:
+            # Slices selecting each cell in this block (a) and its neighbour (b) at this offset
+            ra = slice(r0,min(r1,nrows-dr))
+            rb = slice(r0+dr,min(r1,nrows-dr)+dr)
+            ca = slice(max(0,-dc),ncols-max(0,dc))
+            cb = slice(max(0,dc),ncols+min(0,dc))
+            if ra.stop <= ra.start:
+                continue
+            a = v[ra,ca]
+            b = v[rb,cb]
+            conductance = (a+b)/2.0*map_unit
+            if lats is None:
+                distance = numpy.hypot(dc*grid.xres,dr*grid.yres)
+            else:
+                distance = greatCircle(lats[ra],lats[rb],dc*grid.xres)[:,numpy.newaxis]
+            with numpy.errstate(invalid="ignore"):
+                keep = conductance > 0       # drops NA cells and zero-to-zero moves
+            cost = distance/numpy.where(keep,conductance,1.0)
+            rows, cols = numpy.nonzero(keep)
+            source = ((rows+ra.start)*ncols + cols+ca.start).astype(index)
+            sources.append(source)
+            targets.append((source + (dr*ncols+dc)).astype(index))
+            costs.append(cost[rows,cols])
+            del a, b, conductance, keep, cost, rows, cols
+
+    if not sources:                 # a single row and column: no neighbours at all
+        return coo_matrix((grid.ncell,grid.ncell)).tocsr()
+    sources = numpy.concatenate(sources)
+    targets = numpy.concatenate(targets)
+    costs   = numpy.concatenate(costs)
+    network = coo_matrix((numpy.concatenate((costs,costs)),
+                          (numpy.concatenate((sources,targets)),numpy.concatenate((targets,sources)))),
+                         shape=(grid.ncell,grid.ncell))
+    return network.tocsr()
+
+def accCost(network,cells,min_only=False,limit=numpy.inf):
+    """
+    Accumulated cost from each origin cell (one row per cell), or from the
+    nearest of all the cells if min_only is set.  Unreachable cells are Inf;
+    origins that are off the raster (cell -1) give a row of Inf.  The search
+    stops expanding once the cost passes limit, and cells beyond it are Inf,
+    so a small limit only visits the cells within that budget.
+    """
+    cells = numpy.asarray(cells,dtype=numpy.int64)
+    valid = cells >= 0
+    if min_only:
+        if not valid.any():
+            return numpy.full((1,network.shape[0]),numpy.inf)
+        # One sweep from a virtual source joined to every origin by a
+        # negligible cost (csgraph may drop explicit zeros), which is then
+        # taken off again so that the origins themselves cost 0
+        n = network.shape[0]
+        origins = numpy.unique(cells[valid])    # duplicate entries would be summed
+        edges = network.tocoo()
+        joined = coo_matrix((numpy.concatenate((edges.data,numpy.full(len(origins),SOURCE_COST))),
+                             (numpy.concatenate((edges.row,numpy.full(len(origins),n))),
+                              numpy.concatenate((edges.col,origins)))),
+                            shape=(n+1,n+1)).tocsr()
+        costs = dijkstra(joined,directed=True,indices=n,limit=limit)[:n]
+        return numpy.maximum(costs-SOURCE_COST,0.0)[numpy.newaxis,:]
+    result = numpy.full((len(cells),network.shape[0]),numpy.inf)
+    if valid.any():
+        result[valid] = dijkstra(network,directed=True,indices=cells[valid],limit=limit)
+    return result
+
+# Coarse-to-fine evaluation.  On a large map, the exact cost to the far
+# corners is rarely what anyone looks at, so the search from each point can
+# be split in two:
+#
+#   - near field: the exact search on the full-resolution network, stopped
+#     once the cost passes a radius (dijkstra's limit, so it only visits the
+#     cells within that cost);
+#   - far field: a search on a coarse copy of the map (a Pyramid: blocks of
+#     factor x factor cells), whose costs, scaled by the factor, fill in the
+#     cells beyond the radius.
+#
+# A coarse cell's value is that of its fastest cell, so that roads and trails
+# narrower than a block stay connected in the coarse map (a mean would lose
+# them), and a coarse cell is NA if most of its cells are.  Far-field costs
+# are therefore somewhat optimistic: a lower estimate that bounds the exact
+# cost.  As the costs are in cells traversed per unit of value, a coarse
+# step stands for factor full-resolution steps.  The radius is the
+# accuracy/speed knob: everything cheaper than it is exact.
+
+class Pyramid(object):
+    "A coarse copy of a grid and its cost network, for the far field of a search"
+
+    def __init__(self,grid,factor,block_rows=None):
+        self.factor  = int(factor)
+        self.grid    = aggregateGrid(grid,self.factor)
+        self.network = costNetwork(self.grid,block_rows)
+        cells        = numpy.arange(grid.ncell)
+        rows, cols   = cells//grid.ncols, cells%grid.ncols
+        self.lookup  = (rows//self.factor)*self.grid.ncols + cols//self.factor  # coarse cell of each cell
+        self.na      = numpy.isnan(grid.values).ravel()
+
+    def coarseCells(self,cells):
+        "Coarse cells of full-resolution cells; -1 for -1 and for NA coarse cells"
+        cells  = numpy.asarray(cells,dtype=numpy.int64)
+        coarse = numpy.where(cells>=0,self.lookup[numpy.maximum(cells,0)],-1)
+        coarse[coarse>=0] = numpy.where(numpy.isnan(self.grid.values.flat[coarse[coarse>=0]]),-1,coarse[coarse>=0])
+        return coarse
+
+def aggregateGrid(grid,factor):
+    "Coarse grid of factor x factor blocks (fastest cell; NA if most cells are NA)"
+    nrows = -(-grid.nrows//factor)
+    ncols = -(-grid.ncols//factor)
+    values = numpy.full((nrows*factor,ncols*factor),numpy.nan)
+    values[:grid.nrows,:grid.ncols] = grid.values
+    blocks = values.reshape((nrows,factor,ncols,factor))
+    count  = (~numpy.isnan(blocks)).sum(axis=(1,3))
+    coarse = numpy.where(numpy.isnan(blocks),-numpy.inf,blocks).max(axis=(1,3))
+    # Cells of the map in each block (fewer in the partial blocks at the edges)
+    height = numpy.minimum(factor,grid.nrows-numpy.arange(nrows)*factor)
+    width  = numpy.minimum(factor,grid.ncols-numpy.arange(ncols)*factor)
+    coarse[2*count <= height[:,numpy.newaxis]*width[numpy.newaxis,:]] = numpy.nan
+    transform = list(grid.transform)
+    transform[1] *= factor
+    transform[5] *= factor
+    return Grid(coarse,transform,grid.projection)
+
+def pyramidAccCost(network,pyramid,cells,near_field,min_only=False,limit=numpy.inf):
+    """
+    accCost with the search on the full-resolution network stopped at
+    near_field, and the cells beyond it filled in from the coarse network
+    of the pyramid (see above).  Cells beyond limit are still Inf.
+    """
+    near = accCost(network,cells,min_only,min(near_field,limit))
+    far  = accCost(pyramid.network,pyramid.coarseCells(cells),min_only,limit/pyramid.factor)
+    far  = numpy.maximum(far[:,pyramid.lookup]*pyramid.factor,near_field)
+    costs = numpy.where(numpy.isinf(near),far,near)
+    costs[:,pyramid.na] = numpy.inf
+    costs[costs>limit] = numpy.inf
+    return costs
+
+# Origins searched at a time by destinationCost (each search holds a full row
+# of costs until the destination columns are picked out)
+ORIGIN_BLOCK = 64
+
+def uniqueCells(cells):
+    """
+    The distinct cells to search from (leaving out -1), and for each of the
+    given cells its row among them (-1 for cells left out).
+    """
+    cells = numpy.asarray(cells,dtype=numpy.int64)
+    valid = cells >= 0
+    unique, inverse = numpy.unique(cells[valid],return_inverse=True)
+    index = numpy.full(len(cells),-1,dtype=numpy.int64)
+    index[valid] = inverse
+    return unique, index
+
+def fanOut(rows,index,width):
+    "Rows (one per unique cell) back out to the original cells; Inf where index is -1"
+    result = numpy.full((len(index),width),numpy.inf)
+    result[index>=0] = rows[index[index>=0]]
+    return result
+
+def destinationCost(network,cells,destinations,limit=numpy.inf):
+    """
+    Accumulated cost from each origin cell to each destination cell, as a
+    matrix with one row per origin and one column per destination.  Only
+    the destination columns of each search are kept, so no more than
+    ORIGIN_BLOCK full rows are held at once.  Destinations that are off the
+    raster (cell -1), like unreachable ones, are Inf.
+    """
+    cells        = numpy.asarray(cells,dtype=numpy.int64)
+    destinations = numpy.asarray(destinations,dtype=numpy.int64)
+    valid  = destinations >= 0
+    result = numpy.full((len(cells),len(destinations)),numpy.inf)
+    for start in range(0,len(cells),ORIGIN_BLOCK):
+        costs = accCost(network,cells[start:start+ORIGIN_BLOCK],limit=limit)
+        result[start:start+ORIGIN_BLOCK,valid] = costs[:,destinations[valid]]
+    return result
+
+# Network (and pyramid) shared with the worker processes of parallelAccCost.
+# They are set before the pool is created so that forked workers inherit
+# them rather than having them pickled to each of them.
+_shared_network = None
+_shared_pyramid = None
+
+def _shardCost(args):
+    "Accumulated cost for one shard of origin cells (runs in a pool worker)"
+    cells, limit, destinations, near_field = args
+    if destinations is not None:
+        return destinationCost(_shared_network,cells,destinations,limit)
+    if _shared_pyramid is not None:
+        return pyramidAccCost(_shared_network,_shared_pyramid,cells,near_field,limit=limit)
+    return accCost(_shared_network,cells,limit=limit)
+
+def parallelAccCost(network,cells,workers,limit=numpy.inf,progress=None,destinations=None,
+                    pyramid=None,near_field=None):
+    """
+    accCost for many origin cells, sharded across a pool of worker processes
+    that share the network.  Rows come back in the original cell order;
+    progress (if given) is called with (points done, total points) as each
+    shard completes.  If destinations are given, each row holds only the
+    costs to those cells (as destinationCost); otherwise, if a pyramid is
+    given, the rows are as pyramidAccCost.
+    """
+    global _shared_network, _shared_pyramid
+    try:
+        import billiard as multiprocessing  # Celery's fork, which allows pools inside a worker
+    except ImportError:
+        import multiprocessing
+    cells  = numpy.asarray(cells,dtype=numpy.int64)
+    shards = [ s for s in numpy.array_split(cells,min(workers,len(cells))) if len(s) ]
+    _shared_network = network
+    _shared_pyramid = pyramid
+    pool = multiprocessing.Pool(len(shards))
+    try:
+        parts, done = [], 0
+        for part in pool.imap(_shardCost,[ (shard,limit,destinations,near_field) for shard in shards ]):
+            parts.append(part)
+            done += len(part)
+            if progress:
+                progress(done,len(cells))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _shared_network = None
+        _shared_pyramid = None
+    return numpy.vstack(parts)
+
+def isochrones(grid,network,cells,per_point=True,max_cost=None,workers=1,progress=None,
+               pyramid=None,near_field=None):
+    """
+    Isochrone bands laid out as DoAccess2 writes them: Destinations (the
+    cost to the nearest point) first, then one band per point if per_point
+    is set.  Returns an array of shape (bands,nrows,ncols) with NaN for
+    cells that cannot be reached, or that lie beyond max_cost if given.
+    Per-point bands are computed by up to workers processes in parallel.
+    Points that share a cell are searched once; points with cell -1 (off
+    the raster or in an NA cell) get empty bands.  If a pyramid is given,
+    costs are exact only up to near_field (see pyramidAccCost).
+    """
+    limit = max_cost if max_cost else numpy.inf
+    if pyramid is not None:
+        search = lambda cells, min_only=False: pyramidAccCost(network,pyramid,cells,near_field,min_only,limit)
+    else:
+        search = lambda cells, min_only=False: accCost(network,cells,min_only,limit)
+    # Search once from each distinct cell, then fan out to the points
+    unique, index = uniqueCells(cells)
+    if not per_point:
+        costs = search(unique,min_only=True)
+    else:
+        if workers > 1 and len(unique) > 1:
+            rows = parallelAccCost(network,unique,workers,limit,progress,pyramid=pyramid,near_field=near_field)
+        elif len(unique):
+            rows = search(unique)
+        else:
+            rows = numpy.empty((0,network.shape[0]))
+        costs = fanOut(rows,index,network.shape[0])
+
+    # accCost produces Inf for cells that can't be reached; make those NA
+    costs[numpy.isinf(costs)] = numpy.nan
+    # accCost produces 0 for cells that coincide with Points; make those half the non-zero shortest distance
+    positive = costs[costs>0]
+    if positive.size:
+        costs[costs==0] = positive.min()/2.0
+
+    if per_point:
+        with numpy.errstate(invalid="ignore"):
+            destinations = numpy.fmin.reduce(costs,axis=0)
+        costs = numpy.vstack((destinations[numpy.newaxis,:],costs))
+    return costs.reshape((-1,grid.nrows,grid.ncols))
+
+def odMatrix(network,origins,destinations,max_cost=None,workers=1,progress=None):
+    """
+    Origin-destination cost matrix (one row per origin cell, one column per
+    destination cell), read from the shortest-path searches at the
+    destination cells without building any isochrone bands.  Costs that
+    cannot be reached, or that are beyond max_cost if given, are NaN.
+    """
+    limit = max_cost if max_cost else numpy.inf
+    # Search once from each distinct origin cell, then fan out to the origins
+    unique, index = uniqueCells(origins)
+    if workers > 1 and len(unique) > 1:
+        rows = parallelAccCost(network,unique,workers,limit,progress,destinations)
+    else:
+        rows = destinationCost(network,unique,destinations,limit)
+    costs = fanOut(rows,index,len(destinations))
+    costs[numpy.isinf(costs)] = numpy.nan
+    return costs
+
+def writeGrid(filename,grid,bands,datatype="Float64",options=None):
+    """
+    Write a (bands,nrows,ncols) array to a GeoTIFF with the grid's
+    georeferencing, as the given data type (see geotiff.DataTypes) and
+    with any GDAL creation options.
+    """
+    bands = numpy.asarray(bands,dtype=numpy.float64)
+    if bands.ndim == 2:
+        bands = bands[numpy.newaxis,:,:]
+    na_flag = geotiff.DataTypes[datatype][1]
+    driver = gdal.GetDriverByName("GTiff")
+    ds = driver.Create(filename,grid.ncols,grid.nrows,bands.shape[0],
+                       gdal.GetDataTypeByName(datatype),options or [])
+    ds.SetGeoTransform(grid.transform)
+    ds.SetProjection(grid.projection)
+    for i in range(bands.shape[0]):
+        values = bands[i]
+        if datatype == "Int16":
+            values = numpy.round(values)
+        band = ds.GetRasterBand(i+1)
+        band.SetNoDataValue(na_flag)
+        band.WriteArray(numpy.where(numpy.isnan(values),na_flag,values))
+    ds.FlushCache()
+    ds = None
+
+def warpToLonLat(source,destination,datatype="Float64",options=None):
+    """
+    Reproject a GeoTIFF to EPSG:4326 with bilinear resampling (as projectRaster
+    does by default), for display in the NMTK.
+    """
+    ds = gdal.Warp(destination,source,format="GTiff",dstSRS="EPSG:4326",
+                   resampleAlg="bilinear",dstNodata=geotiff.DataTypes[datatype][1],
+                   outputType=gdal.GetDataTypeByName(datatype),creationOptions=options or [])
+    if ds is None:
+        raise Exception("Unable to reproject raster file: %s"%(source,))
+    ds = None
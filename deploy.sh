@@ -23,6 +23,7 @@ sudo su - -c "R --quiet -f $DIR/system/Rpackages.R"
 echo "(Re)installing Rserve as a service"
 sudo update-rc.d -f Rserve remove
 sudo cp $DIR/system/Rserv.conf /etc/Rserv.conf
+sudo cp $DIR/system/AccessR.R /etc/AccessR.R
 sudo cp $DIR/system/Rserve.init /etc/init.d/Rserve
 sudo chmod 0755 /etc/init.d/Rserve
 sudo update-rc.d Rserve defaults 92
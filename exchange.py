@@ -0,0 +1,117 @@
+# Files exchanged between the Celery worker and Rserve.
+#
+# Every raster, point, shard and network file the tools hand between Python
+# and R goes through a temporary file.  Those files are named here, in an
+# exchange folder that can be put on a RAM-backed filesystem (tmpfs, e.g.
+# /dev/shm) through ACCESSR_EXCHANGE_DIR, so that the round trips through
+# them never touch a disk.  The folder must be writable by both the worker
+# and Rserve (which run on the same host).
+#
+# Each job gets its own scratch folder in the exchange folder (a Scratch,
+# job.scratch), which is removed as a whole when the job ends.  Folders left
+# behind by workers that crashed are swept in the background once they are
+# older than ACCESSR_SCRATCH_MAX_AGE seconds.
+#
+# The pipeline subtool also has a shortcut for the native engine: instead of
+# decoding the accessibility map it just wrote as a (possibly compressed)
+# GeoTIFF, the map held in R is written as raw little-endian doubles and
+# memory-mapped straight into the engine's Grid.
+
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+
+EXCHANGE_DIR   = os.environ.get("ACCESSR_EXCHANGE_DIR","") or tempfile.gettempdir()
+SCRATCH_PREFIX = "accessr-job-"
+MAX_AGE        = float(os.environ.get("ACCESSR_SCRATCH_MAX_AGE",6*3600))  # seconds before a folder is stale
+SWEEP_INTERVAL = float(os.environ.get("ACCESSR_SWEEP_INTERVAL",600))      # seconds between sweeps
+
+def tempName(suffix="",folder=None):
+    """
+    A new, unused file name in folder (by default the exchange folder).  The
+    file is not created, so R can tell that (for example) a network has not
+    been saved yet.
+    """
+    return os.path.join(folder or EXCHANGE_DIR,"accessr-%s%s"%(uuid.uuid4().hex,suffix))
+
+class Scratch(object):
+    "A job's scratch folder in the exchange folder"
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix=SCRATCH_PREFIX,dir=EXCHANGE_DIR)
+        os.chmod(self.path,0777)        # Rserve may run as a different user
+
+    def tempName(self,suffix=""):
+        "A new, unused file name in the scratch folder"
+        return tempName(suffix,self.path)
+
+    def remove(self,R=None):
+        """
+        Remove the folder and everything in it.  Files that Rserve created
+        and this process cannot delete are removed by R (if a session is
+        given), in one call.
+        """
+        shutil.rmtree(self.path,ignore_errors=True)
+        if R is not None and os.path.exists(self.path):
+            import rpool
+            rpool.call(R,"accessr.remove.folder",self.path)
+
+def sweep(max_age=MAX_AGE):
+    "Remove scratch folders not modified for max_age seconds; returns how many"
+    removed = 0
+    cutoff = time.time()-max_age
+    for name in os.listdir(EXCHANGE_DIR):
+        path = os.path.join(EXCHANGE_DIR,name)
+        try:
+            if name.startswith(SCRATCH_PREFIX) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path,ignore_errors=True)
+                removed += 1
+        except OSError:
+            pass                        # removed by another worker meanwhile
+    return removed
+
+_last_sweep = 0
+
+def sweepInBackground(logger=None):
+    "Start a sweep in a daemon thread, at most once every SWEEP_INTERVAL seconds"
+    global _last_sweep
+    if time.time()-_last_sweep < SWEEP_INTERVAL:
+        return
+    _last_sweep = time.time()
+    def run():
+        try:
+            removed = sweep()
+            if removed and logger:
+                logger.info("Removed %d stale scratch folder(s) from %s"%(removed,EXCHANGE_DIR))
+        except Exception:
+            if logger:
+                logger.exception("Scratch folder sweep failed")
+    thread = threading.Thread(target=run,name="accessr-sweep")
+    thread.daemon = True
+    thread.start()
+
+def gridFromR(R,folder=None):
+    """
+    The map held in an R session (the job's map in the R library), as a
+    costdistance.Grid whose values are memory-mapped from a raw file in
+    folder (by default the exchange folder).
+    """
+    import numpy
+    from osgeo import osr
+    import costdistance
+    import rpool
+
+    rawfile = tempName(".raw",folder)
+    try:
+        nrow, ncol, xmin, ymax, xres, yres = [ float(v) for v in rpool.call(R,"accessr.map.raw",rawfile) ]
+        srs = osr.SpatialReference()
+        srs.ImportFromProj4(str(rpool.call(R,"accessr.map.projection")))
+        # Copy-on-write, so the grid can be modified without touching the file
+        values = numpy.memmap(rawfile,dtype="<f8",mode="c",shape=(int(nrow),int(ncol)))
+    finally:
+        if os.path.exists(rawfile):
+            os.unlink(rawfile)          # the mapping stays valid until it is released
+    return costdistance.Grid(values,(xmin,xres,0.0,ymax,0.0,-yres),srs.ExportToWkt())
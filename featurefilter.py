@@ -0,0 +1,141 @@
+# Bounding-box prefilter for the overlay files used by the Access1 subtool.
+#
+# Regional road, trail and building files are usually much larger than the
+# study area of any one map, but readOGR loads (and spTransform reprojects)
+# every feature in the file before rasterize can discard the ones that fall
+# outside the map.  Before a layer is handed to R, its features are streamed
+# through here (with pointfile.iterFeatures) and only those whose bounding
+# box intersects the map's extent are written to a smaller GeoJSON file:
+#
+#   - the map's extent is taken in the CRS the file declares in its "crs"
+#     member (longitude/latitude if it has none, as GeoJSON assumes), as
+#     long as that CRS is given by an EPSG code or as CRS84; a file in any
+#     other CRS is passed to R unfiltered, and readOGR and spTransform deal
+#     with it as before;
+#   - a feature is kept if its coordinate bounding box intersects the extent
+#     (a cheap, conservative test: rasterize still clips exactly);
+#   - features without a geometry are dropped, as rasterize ignores them;
+#   - the "crs" member is copied to the filtered file unchanged.
+#
+# Only the kept features are ever held in memory, in R or in Python.
+
+import re
+import json
+import pointfile
+
+# Start of the "crs" member, and the EPSG code (or CRS84) in a CRS name such
+# as "EPSG:26918" or "urn:ogc:def:crs:EPSG::26918"
+CRS_MEMBER = re.compile(r'"crs"\s*:\s*')
+EPSG_NAME  = re.compile(r'EPSG:[0-9.]*:*([0-9]+)$',re.IGNORECASE)
+CRS84_NAME = re.compile(r'CRS:?84$',re.IGNORECASE)
+
+# Bytes read at each end of a file when looking for its "crs" member
+CRS_SEARCH = 64*1024
+
+def geometryBounds(geometry):
+    "Bounding box (xmin, xmax, ymin, ymax) of a GeoJSON geometry, or None if empty"
+    if geometry.get("type") == "GeometryCollection":
+        boxes = [ b for b in (geometryBounds(g) for g in geometry.get("geometries",[])) if b ]
+        if not boxes:
+            return None
+        return ( min(b[0] for b in boxes), max(b[1] for b in boxes),
+                 min(b[2] for b in boxes), max(b[3] for b in boxes) )
+    xs, ys = [], []
+    stack = [ geometry.get("coordinates",[]) ]
+    while stack:
+        coordinates = stack.pop()
+        if coordinates and isinstance(coordinates[0],(int,long,float)):
+            xs.append(coordinates[0])
+            ys.append(coordinates[1])
+        else:
+            stack.extend(coordinates)
+    if not xs:
+        return None
+    return ( min(xs), max(xs), min(ys), max(ys) )
+
+def _findCRS(text):
+    "The \"crs\" member found in a piece of a GeoJSON document, or None"
+    decoder = json.JSONDecoder()
+    for match in CRS_MEMBER.finditer(text):
+        try:
+            crs, end = decoder.raw_decode(text,match.end())
+        except ValueError:
+            continue                    # cut off by the end of the piece
+        if crs is None or isinstance(crs,dict):
+            return crs
+    return None
+
+def documentCRS(vectorfile):
+    """
+    The "crs" member of a GeoJSON FeatureCollection (a dict), or None if it
+    has none.  The member is looked for ahead of the features array, and
+    after it at the end of the file.
+    """
+    f = open(vectorfile,"r")
+    try:
+        head = f.read(CRS_SEARCH)
+        features = pointfile.FEATURES.search(head)
+        crs = _findCRS(head[:features.start()] if features else head)
+        if crs is None:
+            f.seek(0,2)
+            size = f.tell()
+            f.seek(max(0,size-CRS_SEARCH))
+            tail = f.read()
+            crs = _findCRS(tail[tail.rfind("]"):])
+    finally:
+        f.close()
+    return crs
+
+def epsgCode(crs):
+    """
+    EPSG code of a GeoJSON "crs" member (4326 for CRS84 or no member), or
+    None if the CRS is not given in a form recognized here.
+    """
+    if crs is None:
+        return 4326                     # the GeoJSON default
+    properties = crs.get("properties") or {}
+    if crs.get("type") == "EPSG" and "code" in properties:
+        try:
+            return int(properties["code"])
+        except (TypeError,ValueError):
+            return None
+    name = str(properties.get("name","")) if crs.get("type") == "name" else ""
+    if CRS84_NAME.search(name):
+        return 4326
+    match = EPSG_NAME.search(name)
+    return int(match.group(1)) if match else None
+
+def intersects(a,b):
+    "True if two (xmin, xmax, ymin, ymax) boxes overlap"
+    return a[0] <= b[1] and b[0] <= a[1] and a[2] <= b[3] and b[2] <= a[3]
+
+def filterFeatures(vectorfile,outputfile,extent,crs=None):
+    """
+    Copy the features of a GeoJSON file whose bounding box intersects extent
+    (xmin, xmax, ymin, ymax, in the file's CRS) to outputfile, along with
+    the file's "crs" member (crs, as returned by documentCRS).  Returns
+    (kept, total) feature counts.
+    """
+    kept = total = 0
+    f = open(vectorfile,"r")
+    out = open(outputfile,"w")
+    try:
+        out.write('{"type": "FeatureCollection", ')
+        if crs is not None:
+            out.write('"crs": %s, '%(json.dumps(crs),))
+        out.write('"features": [\n')
+        for feature in pointfile.iterFeatures(f):
+            total += 1
+            geometry = feature.get("geometry")
+            bounds = geometryBounds(geometry) if geometry else None
+            if bounds is None or not intersects(bounds,extent):
+                continue
+            if kept:
+                out.write(",\n")
+            json.dump(feature,out)
+            kept += 1
+        out.write("\n]}\n")
+    finally:
+        out.close()
+        f.close()
+    return kept, total
@@ -0,0 +1,93 @@
+# GeoTIFF output settings shared by the AccessR subtools.
+#
+# Each subtool's output configuration page ("studyarea_output",
+# "accessibility_output", "isochrone_output") carries the same format
+# elements (see OutputFormatElements in tool_configs.py):
+#
+#   datatype    - "Float64" (the writeRaster default), "Float32" or "Int16"
+#                 (Int16 only for accessibility maps: accumulated travel costs
+#                 run far past its range, or round to 0 on projected maps)
+#   compression - "None", "DEFLATE" or "LZW" (with a suitable predictor)
+#   tiled       - write internally tiled (256x256) rather than striped
+#   overviews   - add internal overviews, laid out as a Cloud-Optimized GeoTIFF
+#
+# The settings are turned into writeRaster arguments for the R code, or GDAL
+# creation options for the native engine, and overviews are added afterwards
+# with the GDAL Python bindings.
+
+import os
+
+DataTypes = {
+    # name      : (writeRaster datatype, NA flag, TIFF predictor)
+    "Float64" : ( "FLT8S", -1.797693e+308, 3 ),
+    "Float32" : ( "FLT4S", -3.4e+38,       3 ),
+    "Int16"   : ( "INT2S", -32768,         2 ),
+    }
+
+# Data types that can hold isochrone (accumulated cost) values
+CostDataTypes = [ "Float64", "Float32" ]
+
+Compressions = [ "None", "DEFLATE", "LZW" ]
+
+TILE_SIZE = 256
+
+def dataType(output,choices=None):
+    """
+    Output data type name (a GDAL type name) from an output configuration
+    page, which must be one of choices if given
+    """
+    datatype = output.get("datatype","Float64") or "Float64"
+    if datatype not in DataTypes:
+        raise Exception("Unknown Output Data Type:",datatype)
+    if choices is not None and datatype not in choices:
+        raise Exception("Output Data Type %s cannot hold these values; use one of:"%(datatype,),", ".join(choices))
+    return datatype
+
+def creationOptions(output):
+    "GDAL GeoTIFF creation options from an output configuration page"
+    compression = output.get("compression","None") or "None"
+    if compression not in Compressions:
+        raise Exception("Unknown Output Compression:",compression)
+    options = []
+    if compression != "None":
+        options += [ "COMPRESS="+compression, "PREDICTOR=%d"%(DataTypes[dataType(output)][2],) ]
+    if output.get("tiled",False) or output.get("overviews",False):
+        options += [ "TILED=YES", "BLOCKXSIZE=%d"%(TILE_SIZE,), "BLOCKYSIZE=%d"%(TILE_SIZE,) ]
+    return options
+
+def rasterOptions(output):
+    """
+    writeRaster datatype and creation options (separated by ";") for the
+    write functions of the R library (write.geotiff in system/AccessR.R)
+    """
+    return DataTypes[dataType(output)][0], ";".join(creationOptions(output))
+
+def addOverviews(filename,output):
+    """
+    If the output page asks for overviews, add them to a finished GeoTIFF and
+    rewrite it as a Cloud-Optimized GeoTIFF (tiled, with the overviews stored
+    inside the file ahead of the full-resolution data).
+    """
+    if not output.get("overviews",False):
+        return
+    from osgeo import gdal
+    ds = gdal.Open(filename)
+    if ds is None:
+        raise Exception("Unable to read raster file: %s"%(filename,))
+    levels, factor = [], 2
+    while max(ds.RasterXSize,ds.RasterYSize) > factor*TILE_SIZE/2:
+        levels.append(factor)
+        factor *= 2
+    if not levels:
+        return                  # already small enough to display in one tile
+    ds.BuildOverviews("AVERAGE",levels)     # written alongside as filename.ovr
+    cog = filename+".cog.tif"
+    copy = gdal.GetDriverByName("GTiff").CreateCopy(cog,ds,
+               options=creationOptions(output)+["COPY_SRC_OVERVIEWS=YES"])
+    if copy is None:
+        raise Exception("Unable to write overviews for raster file: %s"%(filename,))
+    copy = None
+    ds = None
+    os.rename(cog,filename)
+    if os.path.exists(filename+".ovr"):
+        os.remove(filename+".ovr")
@@ -0,0 +1,158 @@
+# Content-addressed cache of prepared cost networks for the Access2 subtool.
+#
+# Building the transition/geo-corrected cost network is most of the work in
+# an isochrone job, and analysts tend to evaluate many point files against
+# the same accessibility map.  Networks are therefore cached under a key
+# derived from the bytes of the input raster:
+#
+#   - in memory, in each Celery worker process (native engine networks),
+#     with least-recently-used eviction once a byte budget is exceeded;
+#   - on disk, as serialized sparse matrices (".npz" for the native engine,
+#     ".rds" written by R for the gdistance engine), with least-recently-used
+#     eviction (by modification time) once a byte budget is exceeded.
+#
+# Cache settings can be overridden from the environment of the Celery
+# worker (see the ACCESSR_* names below).  A budget of zero turns that
+# level of the cache off.
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+CACHE_DIR    = os.environ.get("ACCESSR_CACHE_DIR",os.path.join(tempfile.gettempdir(),"accessr-cache"))
+MEMORY_BYTES = int(os.environ.get("ACCESSR_CACHE_MEMORY_BYTES",512*1024*1024))
+DISK_BYTES   = int(os.environ.get("ACCESSR_CACHE_DISK_BYTES",4*1024*1024*1024))
+
+# Change this whenever the way a network is built changes, so that networks
+# prepared by older code are never picked up.
+NETWORK_VERSION = "1"
+
+def rasterKey(filename):
+    "Cache key for the network built from a raster file (hash of its bytes)"
+    digest = hashlib.sha1(NETWORK_VERSION.encode("ascii"))
+    with open(filename,"rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def networkBytes(network):
+    "Approximate memory used by a scipy.sparse CSR matrix"
+    return network.data.nbytes + network.indices.nbytes + network.indptr.nbytes
+
+class NetworkCache(object):
+    "Two-level (memory and disk) least-recently-used cache of cost networks"
+
+    def __init__(self,directory=CACHE_DIR,memory_bytes=MEMORY_BYTES,disk_bytes=DISK_BYTES):
+        self.directory    = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes   = disk_bytes
+        self.memory       = OrderedDict()   # key -> network, least recently used first
+        self.lock         = threading.Lock()
+
+    def path(self,key,suffix):
+        "Disk location for a cached network (creating the cache folder if needed)"
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+                os.chmod(self.directory,0777)   # Rserve (gdistance networks) may run as a different user
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        return os.path.join(self.directory,key+suffix)
+
+    def touch(self,filename):
+        "Mark a disk entry as recently used"
+        try:
+            os.utime(filename,None)
+        except OSError:
+            pass
+
+    def evictDisk(self):
+        "Remove least recently used disk entries until the disk budget is met"
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                continue                # still being written by some worker
+            filename = os.path.join(self.directory,name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue                # removed by another worker
+            entries.append((st.st_mtime,st.st_size,filename))
+        entries.sort()
+        total = sum(size for mtime,size,filename in entries)
+        for mtime,size,filename in entries:
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def remember(self,key,network):
+        "Keep a network in memory, evicting older ones beyond the memory budget"
+        if self.memory_bytes <= 0:
+            return
+        with self.lock:
+            self.memory.pop(key,None)
+            self.memory[key] = network
+            total = sum(networkBytes(n) for n in self.memory.values())
+            while total > self.memory_bytes and self.memory:
+                oldkey, old = self.memory.popitem(last=False)
+                total -= networkBytes(old)
+
+    def load(self,key):
+        "Return the cached native network for key, or None"
+        with self.lock:
+            network = self.memory.pop(key,None)
+            if network is not None:
+                self.memory[key] = network      # now most recently used
+                return network
+        if self.disk_bytes <= 0:
+            return None
+        filename = self.path(key,".npz")
+        if not os.path.exists(filename):
+            return None
+        import numpy
+        from scipy.sparse import csr_matrix
+        try:
+            stored = numpy.load(filename)
+            try:
+                network = csr_matrix((stored["data"],stored["indices"],stored["indptr"]),
+                                     shape=tuple(stored["shape"]))
+            finally:
+                stored.close()
+        except Exception:
+            return None                 # unreadable (e.g. partly written); rebuild it
+        self.touch(filename)
+        self.remember(key,network)
+        return network
+
+    def save(self,key,network):
+        "Cache a native network in memory and on disk"
+        self.remember(key,network)
+        if self.disk_bytes <= 0:
+            return
+        import numpy
+        filename = self.path(key,".npz")
+        partial  = "%s.%d.tmp"%(filename,os.getpid())
+        with open(partial,"wb") as f:
+            numpy.savez(f,data=network.data,indices=network.indices,
+                        indptr=network.indptr,shape=numpy.array(network.shape))
+        os.rename(partial,filename)     # atomic, so readers never see a partial file
+        self.evictDisk()
+
+# One cache per Celery worker process
+_cache = None
+
+def getCache():
+    "Return the network cache for the current process"
+    global _cache
+    if _cache is None:
+        _cache = NetworkCache()
+    return _cache
@@ -0,0 +1,104 @@
+# Streaming reader for the GeoJSON point files used by the Access2 subtool.
+#
+# The NMTK sometimes delivers "MultiPoint" features where the tools expect
+# "Point" features.  Rather than loading the whole document with json.load,
+# patching the geometries and writing a second GeoJSON file for R to parse
+# again, the point files are read one feature at a time and reduced to
+# plain coordinate lists:
+#
+#   - features are decoded incrementally from the "features" array, so a
+#     large station file is never held in memory as a whole document;
+#   - each MultiPoint is exploded into all of its member points (the old
+#     workaround kept only the first one);
+#   - features without a geometry are skipped, and any other geometry type
+#     is an error.
+#
+# The coordinates are then passed to R as numeric vectors or used directly
+# by the native engine.
+
+import re
+import json
+
+CHUNK_SIZE = 64*1024
+
+# Start of the features array of a FeatureCollection
+FEATURES = re.compile(r'"features"\s*:\s*\[')
+
+class PointSet(object):
+    "Longitude/latitude coordinates and labels of the points in a point file"
+
+    def __init__(self):
+        self.lon     = []
+        self.lat     = []
+        self.labels  = []   # feature id (or number from 1), with ".k" for MultiPoint members
+        self.skipped = 0    # features without a geometry
+
+    def __len__(self):
+        return len(self.lon)
+
+    def add(self,coordinates,label):
+        self.lon.append(float(coordinates[0]))
+        self.lat.append(float(coordinates[1]))
+        self.labels.append(label)
+
+def iterFeatures(f,chunk_size=CHUNK_SIZE):
+    "Decode the features of a GeoJSON FeatureCollection one at a time"
+    decoder = json.JSONDecoder()
+    buf = ""
+    while True:
+        match = FEATURES.search(buf)
+        if match:
+            break
+        chunk = f.read(chunk_size)
+        if not chunk:
+            raise Exception("No features found in GeoJSON file")
+        buf = buf[-1024:] + chunk       # keep enough to catch a key split across chunks
+    buf, pos = buf[match.end():], 0
+    while True:
+        # Skip to the next feature (or the end of the array)
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buf):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise Exception("GeoJSON file ends in the middle of the features")
+            buf, pos = chunk, 0
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            feature, end = decoder.raw_decode(buf,pos)
+        except ValueError:
+            # Feature not complete yet: read more (at least doubling the buffer)
+            chunk = f.read(max(chunk_size,len(buf)-pos))
+            if not chunk:
+                raise Exception("Unable to parse GeoJSON file near: %s"%(buf[pos:pos+80],))
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield feature
+        pos = end
+        if pos > chunk_size:
+            buf, pos = buf[pos:], 0
+
+def readPoints(filename):
+    "Read a GeoJSON point file into a PointSet, exploding MultiPoint features"
+    points = PointSet()
+    f = open(filename,"r")
+    try:
+        for n, feature in enumerate(iterFeatures(f)):
+            label = feature.get("id",n+1)
+            geometry = feature.get("geometry")
+            if not geometry:
+                points.skipped += 1
+            elif geometry["type"] == "Point":
+                points.add(geometry["coordinates"],label)
+            elif geometry["type"] == "MultiPoint":
+                for k, coordinates in enumerate(geometry["coordinates"]):
+                    points.add(coordinates,"%s.%d"%(label,k+1))
+            else:
+                raise Exception("Point file contains a %s feature (id %s)"%(geometry["type"],label))
+    finally:
+        f.close()
+    if not len(points):
+        raise Exception("No points found in point file")
+    return points
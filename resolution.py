@@ -0,0 +1,79 @@
+# Grid size selection for the Access0 (study area) subtool.
+#
+# A fixed number of X and Y cells oversamples a small site and leaves a
+# large region too coarse.  The grid can instead be chosen from the size of
+# the study area:
+#
+#   - a target cell size in metres (square cells on the ground), or
+#   - a maximum cell budget: the finest square cells whose total count fits
+#     the budget;
+#
+# and a budget also caps the grid chosen by cell size or by fixed counts.
+# For a longitude/latitude map the cell size is converted to degrees at the
+# middle latitude of the study area; a projected working CRS is assumed to
+# be in metres.
+#
+# The number of cells drives the cost of everything downstream, above all
+# the isochrone step, so the chosen grid is reported with a rough estimate
+# of that cost.  The estimate scales per-cell figures for each engine; they
+# are order-of-magnitude values and can be recalibrated from the per-stage
+# records that benchmark.py writes (seconds divided by cells).
+
+import math
+
+METRES_PER_DEGREE = 111320.0    # length of a degree of latitude (and of longitude at the equator)
+
+# Rough seconds per cell: building the cost network, and one shortest-path
+# sweep (one point's isochrone band)
+COST_PER_CELL = {
+    "gdistance" : { "network" : 2.0e-5, "point" : 1.0e-5 },
+    "scipy"     : { "network" : 1.5e-6, "point" : 1.0e-6 },
+    }
+
+def groundSize(extent,lonlat):
+    "Width and height (metres) of an (xmin, xmax, ymin, ymax) extent"
+    xmin, xmax, ymin, ymax = extent
+    if not lonlat:
+        return xmax-xmin, ymax-ymin
+    middle = math.radians((ymin+ymax)/2.0)
+    return (xmax-xmin)*METRES_PER_DEGREE*math.cos(middle), (ymax-ymin)*METRES_PER_DEGREE
+
+def gridDimensions(extent,lonlat,cell_size=0,max_cells=0,raster_x=300,raster_y=300):
+    """
+    Number of X and Y cells for a study area with the given extent: from
+    cell_size (metres) if it is set, else the finest grid within max_cells
+    if that is set, else raster_x by raster_y; capped at max_cells if set.
+    """
+    width, height = groundSize(extent,lonlat)
+    if width <= 0 or height <= 0:
+        raise Exception("Study area has no extent:",extent)
+    if cell_size > 0:
+        nx, ny = width/cell_size, height/cell_size
+    elif max_cells > 0:
+        nx, ny = math.sqrt(max_cells*width/height), math.sqrt(max_cells*height/width)
+    else:
+        nx, ny = raster_x, raster_y
+    if max_cells > 0 and nx*ny > max_cells:
+        scale = math.sqrt(max_cells/float(nx*ny))
+        nx, ny = nx*scale, ny*scale
+    nx, ny = max(1,int(nx)), max(1,int(ny))     # round down to stay within a budget
+    return nx, ny
+
+def estimatedCost(ncell,points=1,engine="gdistance"):
+    "Rough seconds to prepare the network and to evaluate each point, and the total"
+    figures = COST_PER_CELL[engine]
+    network = figures["network"]*ncell
+    point   = figures["point"]*ncell
+    return network, point, network+point*points
+
+def costSummary(ncell):
+    "One-line summary of the estimated isochrone cost of a grid, for status messages"
+    parts = []
+    for engine in sorted(COST_PER_CELL):
+        network, point = estimatedCost(ncell,1,engine)[:2]
+        parts.append("%s about %.1fs network + %.1fs per point"%(engine,network,point))
+    return "; ".join(parts)
+
+def costGuide(sizes=(100000,1000000,4000000)):
+    "Rough isochrone costs for a few grid sizes, for the configuration page"
+    return "\n".join( "%d cells: %s"%(ncell,costSummary(ncell)) for ncell in sizes )
@@ -0,0 +1,191 @@
+# A small pool of pre-warmed Rserve connections.
+#
+# Each Rserve connection is a forked R process, and each subtool needs
+# sp, rgdal, raster and gdistance loaded before it can do anything
+# useful.  Connecting and loading those packages takes several seconds,
+# so rather than paying that cost on every job we keep a few connections
+# open in each Celery worker process, health-check them when they are
+# handed out, and clear the R global environment when they come back.
+#
+# Pool settings can be overridden from the environment of the Celery
+# worker (see the ACCESSR_* names below).
+
+import os
+import time
+import threading
+import pyRserve
+
+RSERVE_HOST = os.environ.get("ACCESSR_RSERVE_HOST", "localhost")
+RSERVE_PORT = int(os.environ.get("ACCESSR_RSERVE_PORT", 6311))
+POOL_SIZE   = int(os.environ.get("ACCESSR_POOL_SIZE", 2))     # connections per worker process
+POOL_WAIT   = float(os.environ.get("ACCESSR_POOL_WAIT", 300)) # seconds to wait for a free connection
+MAX_USES    = int(os.environ.get("ACCESSR_POOL_MAX_USES", 50)) # recycle a session after this many jobs
+
+# R function library (system/AccessR.R).  Rserve normally sources it at
+# startup (see system/Rserv.conf); a new connection sources it here if it is
+# missing or older than LIBRARY_VERSION.  The path must be readable by Rserve.
+LIBRARY_PATH    = os.environ.get("ACCESSR_LIBRARY",
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)),"system","AccessR.R"))
+LIBRARY_VERSION = 3
+
+# R code run once on each new connection, so the analysis can start computing
+# right away.  Anything loaded here survives the reset between jobs since it
+# lives in attached packages (and the attached AccessR library) rather than
+# the global environment.
+WARMUP = """
+suppressMessages({
+    require(sp)
+    require(rgdal)
+    require(raster)
+    require(gdistance)
+})
+if ( !("AccessR" %in% search()) ||
+     get("accessr.version",envir=as.environment("AccessR")) < library_version ) {
+    source(library_path)
+}
+rm(library_path,library_version)
+invisible(TRUE)
+"""
+
+# R code run when a connection is returned to the pool: drop the job's state
+# in the library and anything left in the global environment, undo any
+# raster options it set (e.g. for tiled processing), remove raster's
+# temporary files and let R give back the memory.
+RESET = """
+if ( exists("accessr.reset") ) accessr.reset()
+rm(list=ls(envir=globalenv(),all.names=TRUE),envir=globalenv())
+if ( "package:raster" %in% search() ) {
+    invisible(capture.output(rasterOptions(default=TRUE)))
+    invisible(removeTmpFiles(h=0))
+}
+invisible(gc())
+"""
+
+def call(conn,function,*args):
+    """
+    Call a function of the R library (system/AccessR.R) in a session with
+    typed arguments, and return its value
+    """
+    return getattr(conn.r,function)(*args)
+
+def _close(conn):
+    "Close a connection, ignoring errors from one that is already dead"
+    try:
+        if not conn.isClosed:
+            conn.close()
+    except Exception:
+        pass
+
+class RSessionPool(object):
+    "Per-process pool of warmed-up Rserve connections"
+
+    def __init__(self,size=POOL_SIZE,host=RSERVE_HOST,port=RSERVE_PORT):
+        self.size  = max(1,size)
+        self.host  = host
+        self.port  = port
+        self.idle  = []             # connections ready to hand out
+        self.uses  = {}             # id(connection) -> number of jobs served
+        self.count = 0              # connections open (idle or checked out)
+        self.cond  = threading.Condition()
+
+    def connect(self):
+        "Open and warm up a new Rserve connection"
+        conn = pyRserve.connect(host=self.host,port=self.port)
+        try:
+            conn.r.library_path    = LIBRARY_PATH
+            conn.r.library_version = LIBRARY_VERSION
+            conn.voidEval(WARMUP)
+        except:
+            self.discard(conn,counted=False)
+            raise
+        self.uses[id(conn)] = 0
+        return conn
+
+    def healthy(self,conn):
+        "True if the connection is open and R still answers"
+        try:
+            return (not conn.isClosed) and conn.eval("1L") == 1
+        except Exception:
+            return False
+
+    def discard(self,conn,counted=True):
+        "Close a connection and forget about it"
+        self.uses.pop(id(conn),None)
+        _close(conn)
+        if counted:
+            with self.cond:
+                self.count -= 1
+                self.cond.notify()
+
+    def acquire(self,wait=True):
+        """
+        Hand out a healthy connection, opening a new one if the pool has room.
+        If the pool is exhausted, wait for a connection to be released, or
+        return None straight away if wait is False.
+        """
+        deadline = time.time()+POOL_WAIT
+        with self.cond:
+            while True:
+                while self.idle:
+                    conn = self.idle.pop()
+                    if self.healthy(conn):
+                        return conn
+                    self.uses.pop(id(conn),None)
+                    _close(conn)
+                    self.count -= 1
+                if self.count < self.size:
+                    self.count += 1
+                    break
+                if not wait:
+                    return None
+                # Another waiter may take a released connection first: keep
+                # waiting until the deadline rather than giving up
+                remaining = deadline-time.time()
+                if remaining <= 0:
+                    raise Exception("No Rserve connection available after %d seconds"%(POOL_WAIT,))
+                self.cond.wait(remaining)
+        try:
+            return self.connect()
+        except:
+            with self.cond:
+                self.count -= 1
+                self.cond.notify()
+            raise
+
+    def release(self,conn):
+        "Reset a connection's R session and return it to the pool"
+        if conn is None:
+            return
+        self.uses[id(conn)] = self.uses.get(id(conn),0) + 1
+        try:
+            conn.oobCallback = None
+            conn.voidEval(RESET)
+            reusable = self.uses[id(conn)] < MAX_USES and self.healthy(conn)
+        except Exception:
+            reusable = False
+        if not reusable:
+            self.discard(conn)
+            return
+        with self.cond:
+            self.idle.append(conn)
+            self.cond.notify()
+
+    def close(self):
+        "Close all idle connections (checked-out ones close when released)"
+        with self.cond:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self.discard(conn)
+
+# The pool is created lazily so that each forked Celery worker process gets
+# its own connections rather than sharing sockets inherited from the parent.
+_pool = None
+_pool_pid = None
+
+def getPool():
+    "Return the Rserve pool for the current process"
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = RSessionPool()
+        _pool_pid = os.getpid()
+    return _pool
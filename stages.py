@@ -0,0 +1,104 @@
+# Stage-level timing and memory instrumentation for the AccessR subtools.
+#
+# Each job gets a StageLog (job.stages) that records one entry per stage of
+# the analysis (read, reproject, rasterize, overlay, transition,
+# geoCorrection, accCost, write, ...):
+#
+#   stage    - name of the stage
+#   source   - "python" or "R", depending on where the stage ran
+#   seconds  - wall-clock time for the stage
+#   memory   - resident set size of the worker at the end of the stage
+#              (Python stages) or the peak R heap during the stage (R stages),
+#              in MB
+#   cells    - number of raster cells involved, where that makes sense
+#
+# Python stages are timed with the StageLog.stage context manager.  R code
+# marks the end of each stage with stage.done("name",cells) (defined in the
+# R library, system/AccessR.R, which keeps the R records in the job's state
+# there), and the R entries are collected into the same log when the
+# subtool finishes.  The whole log is written to the Celery logger and
+# attached to the job results as a small JSON file.
+
+import os
+import json
+import time
+import resource
+
+import rpool
+
+def residentMB():
+    "Current resident set size of this process in MB (peak RSS if unavailable)"
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages*os.sysconf("SC_PAGE_SIZE")/(1024.0*1024.0)
+    except (IOError,OSError,ValueError,IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+class StageTimer(object):
+    "Context manager that records one Python stage in a StageLog"
+
+    def __init__(self,log,name,cells):
+        self.log   = log
+        self.name  = name
+        self.cells = cells
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.log.record(self.name,"python",time.time()-self.start,residentMB(),self.cells)
+        return False
+
+class StageLog(object):
+    "Per-job record of stage timings and memory use"
+
+    def __init__(self,logger=None):
+        self.logger  = logger
+        self.entries = []
+
+    def record(self,stage,source,seconds,memory,cells=None):
+        entry = {
+            "stage"   : stage,
+            "source"  : source,
+            "seconds" : round(seconds,3),
+            "memory"  : round(memory,1),
+            "cells"   : int(cells) if cells is not None else None,
+            }
+        self.entries.append(entry)
+        if self.logger:
+            self.logger.info("stage %(stage)s (%(source)s): %(seconds).3fs, %(memory).1f MB, cells=%(cells)s"%entry)
+
+    def stage(self,name,cells=None):
+        "Time a Python stage:  with job.stages.stage('read'): ..."
+        return StageTimer(self,name,cells)
+
+    def startR(self,R):
+        "Start a new R stage log in a job's R session"
+        rpool.call(R,"accessr.stage.reset")
+
+    def collectR(self,R):
+        "Move the stages recorded so far in a job's R session into this log"
+        try:
+            rows = rpool.call(R,"accessr.stage.collect")
+        except Exception:
+            return              # R session unusable (e.g. a job that failed early)
+        if rows is None:
+            return
+        if isinstance(rows,basestring):
+            rows = [rows]
+        for row in rows:
+            stage, seconds, heap, cells = row.split("|")
+            self.record(stage,"R",float(seconds),float(heap),None if cells == "NA" else float(cells))
+
+    def summary(self):
+        "Total seconds per stage name, for status messages"
+        totals = {}
+        for entry in self.entries:
+            totals[entry["stage"]] = totals.get(entry["stage"],0.0) + entry["seconds"]
+        return ", ".join("%s %.1fs"%(stage,seconds) for stage,seconds in sorted(totals.items()))
+
+    def toJSON(self):
+        "The log as a JSON document, for attaching to the job results"
+        return json.dumps({ "stages" : self.entries },indent=2)
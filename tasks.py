@@ -6,123 +6,185 @@ import datetime
 # For this specific tool, we import the following helpers
 import NMTK_apps.helpers.confighelpers as Config
 import decimal
-import os
-import pyRserve
+import rpool
+import netcache
+import geotiff
+import stages
+import contours
+import pointfile
+import featurefilter
+import exchange
+import resolution
 
 # subtool implementations
 
+# Access0 runs in R as accessr.studyarea.read, .rasterize and .write (see
+# system/AccessR.R), in separate steps so that the pipeline subtool can keep
+# the rasterized study area in memory instead of writing it out.
+
+def RasterizeStudyArea(job,client):
+    """
+    Read the study area, choose the grid size (fixed X and Y cells, a cell
+    size in metres or a cell budget; see resolution.py) and rasterize it in
+    the job's R session.
+    """
+    rasterize = job.getParameters('rasterize')  # Properties/Constants for file
+    parameters = job.getParameters('rasterization_params')
+    infile     = job.datafile('rasterize')      # incoming temporary file
+    value      = rasterize["rastervalue"]       # either a field or value
+    epsg       = int(parameters.get("working_epsg",4326) or 4326)  # CRS of the accessibility map
+    block_rows = int(parameters.get("block_rows",0) or 0)          # tiled processing (0 = in memory)
+
+    job.R.oobCallback = lambda msg, code: client.updateStatus("R: "+msg)
+    xmin, xmax, ymin, ymax, lonlat = [ float(v) for v in rpool.call(job.R,"accessr.studyarea.read",infile,epsg) ]
+    pixels_x, pixels_y = resolution.gridDimensions((xmin,xmax,ymin,ymax),bool(lonlat),
+                                                   float(parameters.get("cell_size",0) or 0),
+                                                   int(parameters.get("max_cells",0) or 0),
+                                                   int(parameters.get("raster_x",300) or 300),
+                                                   int(parameters.get("raster_y",300) or 300))
+    client.updateStatus("Grid %d x %d (%d cells); estimated isochrone cost: %s."%(
+        pixels_x,pixels_y,pixels_x*pixels_y,resolution.costSummary(pixels_x*pixels_y)))
+    rpool.call(job.R,"accessr.studyarea.rasterize",value,pixels_x,pixels_y,block_rows)
+
 def DoAccess0(job,client):
     "Set up a study area from a vector file."
 
     # Retrieve job configuration
-    rasterize = job.getParameters('rasterize')  # Properties/Constants for file
-    parameters = job.getParameters('rasterization_params')
     output = job.getParameters('studyarea_output')
 
-    # Set up values in R
-    job.R.r.infile   = job.datafile('rasterize') # incoming temporary file
-    job.R.r.pixels_x = parameters["raster_x"]
-    job.R.r.pixels_y = parameters["raster_y"]
-    job.R.r.value    = rasterize["rastervalue"]  # either a field or value
-    outputfile       = os.tempnam()+".tif" # writeRaster adds extension if not present
-                                           # so we lose control of the name if we don't
-                                           # make it explicit here.
-    job.R.r.outfile  = outputfile
+    outputfile       = job.scratch.tempName(".tif") # writeRaster adds extension if not present
+                                                   # so we lose control of the name if we don't
+                                                   # make it explicit here.
+    datatype, tiffoptions = geotiff.rasterOptions(output)   # output data type and compression
 
     # Run R analysis
-    analysis = """
-    require(sp)
-    require(rgdal)
-    require(raster)
-    studyarea = readOGR(infile,layer="OGRGeoJSON")
-    self.oobSend("Loaded data; starting analysis.")
-    output.CRS <- CRS("+init=epsg:4326")
-    studyarea = spTransform(studyarea,output.CRS)
-    ex <- extent(studyarea)
-    r.study <- raster(ex,pixels_x,pixels_y,crs=output.CRS)
-    r.study <- rasterize(studyarea,r.study,field=value)
-    self.oobSend("Analysis complete; writing output.")
-    writeRaster(r.study,filename=outfile,format="GTiff",overwrite=TRUE)
-    """
-    job.R.oobCallback = lambda msg, code: client.updateStatus("R: "+msg)
-    job.R.r(analysis,void=True)
+    RasterizeStudyArea(job,client)
+    rpool.call(job.R,"accessr.studyarea.write",outputfile,datatype,tiffoptions)
+
+    with job.stages.stage("overviews"):
+        geotiff.addOverviews(outputfile,output)  # Cloud-Optimized GeoTIFF, if requested
 
     # Prepare results
-    if os.path.exists(outputfile):         # File exists, so we should clean it up
-        job.tempfiles.append(outputfile)
-    outputdata             = open(outputfile,"rb")
+    outputdata             = open(outputfile,"rb")  # streamed to the NMTK, then closed by performModel
     resultfilename         = output.get('studyareafile','StudyArea')+".tif"
-    outfiles               = { "studyarea" : ( resultfilename, outputdata.read(),"image/tiff" ) }
-    outputdata.close()
+    outfiles               = { "studyarea" : ( resultfilename, outputdata,"image/tiff" ) }
 
     results = {}
     results["result_file"] = "studyarea"
     results["files"]       = outfiles
     return results
 
-OverlayFunctions = {
-    "Barrier"  : "function(x,y) ifelse(!is.na(y),0.0,x)",
-    "Obstacle" : "function(x,y) pmin(x,y,na.rm=TRUE)",
-    "Facility" : "function(x,y) pmax(x,y,na.rm=TRUE)",
-    }
+# Overlay styles; the overlay functions themselves are overlay.functions in
+# the R library (system/AccessR.R)
+OverlayStyles = ("Barrier","Obstacle","Facility")
+
+# Additional overlay layers ("overlay2", "overlay3", ...) that Access1 can
+# apply in the same job, in order, after the required "overlay" layer
+from tool_configs import MaxOverlays
+
+def OverlayNamespaces():
+    "File namespaces (in application order) for Access1 overlay layers"
+    return ["overlay"] + [ "overlay%d"%(n,) for n in range(2,MaxOverlays+1) ]
+
+def OptionalInput(job,namespace):
+    """
+    Data file and element values for an optional input file, or None if
+    the job was not given that file.
+    """
+    try:
+        datafile = job.datafile(namespace)
+    except Exception:           # the NMTK has no file for this namespace
+        return None
+    if not datafile:
+        return None
+    return datafile, job.getParameters(namespace)
+
+# Access1 runs in R as accessr.overlay.load (or .from.studyarea), one
+# accessr.overlay.layer per layer and accessr.overlay.write (see
+# system/AccessR.R), so that several overlay layers can be applied to the
+# accessibility map in memory between one read and one write.
+
+def OverlayLayers(job,required=True):
+    """
+    Collect the overlay layers to apply, in order: the "overlay" file, then
+    any of the optional "overlay2", "overlay3", ... files, each with its own
+    overlay style ("overlay_style", "overlay_style2", ...)
+    """
+    parameters = job.getParameters('overlay_type')
+    layers = []
+    for n, namespace in enumerate(OverlayNamespaces()):
+        layer = OptionalInput(job,namespace)
+        if layer is None:
+            if n == 0 and required:
+                raise Exception("No overlay file provided")
+            continue
+        vectorfile, overlay = layer
+        style = parameters.get("overlay_style" + (str(n+1) if n else ""),"Facility")
+        if style not in OverlayStyles:
+            raise Exception("Unknown Overlay Style:",style)
+        layers.append((namespace,vectorfile,overlay["accessibility"],style))
+    return layers
+
+def ApplyOverlays(job,client,layers):
+    "Apply each overlay layer to the map held in the job's R session"
+    # Overlay styles:
+    #   "Barrier" = turn overlapped cells to NA
+    #   "Obstacle" = turn overlapped cells to minimum of two cell values (NA stays NA)
+    #   "Facility" = turn overlapped cells to maximum of two cell values (NA stays NA)
+    extents = {}        # EPSG code -> padded extent of the map in that CRS, for the prefilter
+    for namespace, vectorfile, value, style in layers:
+        # Only features whose bounding box touches the map are passed to R
+        crs = featurefilter.documentCRS(vectorfile)
+        code = featurefilter.epsgCode(crs)
+        if code is None:
+            client.updateStatus("Layer '%s' has a CRS without an EPSG code; passed on unfiltered."%(namespace,))
+            filtered = vectorfile
+        else:
+            if code not in extents:
+                extents[code] = [ float(v) for v in rpool.call(job.R,"accessr.map.extent",code) ]
+            filtered = job.scratch.tempName(".geojson")
+            with job.stages.stage("filter"):
+                kept, total = featurefilter.filterFeatures(vectorfile,filtered,extents[code],crs)
+            client.updateStatus("Layer '%s': %d of %d features intersect the map."%(namespace,kept,total))
+            if not kept:
+                continue
+        # value is a field name or value for computing raster values; style
+        # selects the overlay function
+        rpool.call(job.R,"accessr.overlay.layer",filtered,value,style)
+        client.updateStatus("Applied %s layer '%s'."%(style,namespace))
 
 def DoAccess1(job,client):
     "Add vector of barriers, obstacles and facilities to a study raster"
 
     # Retrieve job configuration
-    overlay = job.getParameters('overlay')  # Properties/Constants for file
-    parameters = job.getParameters('overlay_type')
     output = job.getParameters('accessibility_output')
+    layers = OverlayLayers(job)
 
     # Retrieve accessibility file (raster)
-    # Retrieve layer file for rasterization and overlay (geoJSON)
-    # Retrieve processing type and install suitable overlay function
-    # Construct temporary file name (and stash for unlinking in wrapper)
-    # Run R analysis
-    job.R.r.rasterfile = job.datafile('accessibility')  # path to input raster
-    job.R.r.vectorfile = job.datafile('overlay')       # path to input vector (for overlay)
-    job.R.r.value      = overlay["accessibility"]      # field name or value for computing raster values
-    outputfile         = os.tempnam()+".tif"           # Temporary file name for output
-    job.R.r.outfile    = outputfile
+    # Construct temporary file name (in the job's scratch folder)
+    rasterfile = job.datafile('accessibility')      # path to input raster
+    outputfile = job.scratch.tempName(".tif")       # Temporary file name for output
+    keep_crs   = bool(output.get('keep_crs',False)) # keep a projected working CRS
+    datatype, tiffoptions = geotiff.rasterOptions(output)   # output data type and compression
+    processing = job.getParameters('processing_params')
+    block_rows = int(processing.get('block_rows',0) or 0)   # tiled processing (0 = in memory)
 
-    # Select overlay functions:
-    #   "Barrier" = turn overlapped cells to NA
-    #   "Obstacle" = turn overlapped cells to minimum of two cell values (NA stays NA)
-    #   "Facility" = turn overlapped cells to maximum of two cell values (NA stays NA)
-    factype = parameters["overlay_style"]
-    if factype in OverlayFunctions:
-        job.R.r("overfun<-"+OverlayFunctions[factype])
-    else:
-        raise Exception("Unknown Overlay Style:",factype)
-#     client.updateStatus(" ".join(("Rasterfile:",rasterfile,"R Rasterfile:",job.R.r.rasterfile)))
-#     client.updateStatus(" ".join(("Vectorfile:",vectorfile,"R Rasterfile:",job.R.r.vectorfile)))
-#     client.updateStatus(" ".join(("Outfile:",outputfile,"R Rasterfile:",job.R.r.outfile)))
-
-    analysis = """
-    require(sp)
-    require(rgdal)
-    require(raster)
-    r.raster <- raster(rasterfile)
-    r.vector <- readOGR(vectorfile,layer="OGRGeoJSON")
-    self.oobSend("Loaded data; starting analysis.")
-    r.vector <- spTransform(r.vector,projection(r.raster)) # Force the same projection
-    r.over <- rasterize(r.vector,r.raster,field=value)
-    self.oobSend("Overlay prepared; starting analysis.")
-    Accessibility <- overlay(r.raster,r.over,fun=overfun)
-    Accessibility <- projectRaster(Accessibility,crs=CRS("+init=epsg:4326")) # NMTK struggles with rasters not in longlat
-    self.oobSend("Analysis complete; writing output.")
-    writeRaster(Accessibility,filename=outfile,format="GTiff",overwrite=TRUE)
-    """
     job.R.oobCallback = lambda msg, code: client.updateStatus("R: "+msg)
-    job.R.r(analysis,void=True)
+    rpool.call(job.R,"accessr.overlay.load",rasterfile,block_rows)
+    client.updateStatus("Loaded accessibility map; applying %d overlay layer(s)."%(len(layers),))
+
+    # Apply each layer to the map held in R
+    ApplyOverlays(job,client,layers)
+
+    rpool.call(job.R,"accessr.overlay.write",outputfile,keep_crs,datatype,tiffoptions)
+
+    with job.stages.stage("overviews"):
+        geotiff.addOverviews(outputfile,output)  # Cloud-Optimized GeoTIFF, if requested
 
     # Prepare results
-    if os.path.exists(outputfile):         # File exists, so we should clean it up
-        job.tempfiles.append(outputfile)
-    outputdata             = open(outputfile,"rb")
+    outputdata             = open(outputfile,"rb")  # streamed to the NMTK, then closed by performModel
     resultfilename         = output.get('accessibilityfile','Accessibility')+".tif"
-    outfiles               = { "Accessibility" : ( resultfilename, outputdata.read(),"image/tiff" ) }
-    outputdata.close()
+    outfiles               = { "Accessibility" : ( resultfilename, outputdata,"image/tiff" ) }
 
     results = {}
     results["result_file"] = "Accessibility"
@@ -157,93 +219,415 @@ def DoAccess1(job,client):
 #     results["files"]       = outfiles
 #     return results
 
-# We have to do some reformatting of the raw JSON points file since the
-# NMTK sometimes wants to deliver "MultiPoint" features, but R can
-# only handle "Point" features
-import json
+# The gdistance engine runs in R as accessr.isochrone.load, .network,
+# .evaluate (or .shard and .merge), .fan.out and .write (see
+# system/AccessR.R), in separate steps so that the evaluation in the middle
+# can be sharded across several Rserve sessions.  Points off the map or in NA
+# (barrier) cells are left out of the search, and points that share a cell
+# are searched only once.
 
-def DoAccess2(job,client):
-    "Compute isochrones on an accessibility map from a set of points"
+def ShardedEvaluation(job,client,networkfile,workers):
+    """
+    Split the point cells already loaded in the job's R session into shards
+    and evaluate them concurrently, one shard per Rserve session.  The job's
+    own session takes the first shard; the others borrow idle sessions
+    from the pool (as many as are free, up to workers-1).
+    """
+    from multiprocessing.pool import ThreadPool
+    import numpy
+
+    coords = numpy.atleast_1d(rpool.call(job.R,"accessr.isochrone.cells")).reshape((2,-1)).T
+    sessions = [ job.R ]
+    pool = rpool.getPool()
+    try:
+        while len(sessions) < min(workers,len(coords)):
+            conn = pool.acquire(wait=False)
+            if conn is None:
+                break                   # no more idle sessions; use fewer shards
+            sessions.append(conn)
+
+        shards = [ s for s in numpy.array_split(numpy.arange(len(coords)),len(sessions)) if len(s) ]
+        shardfiles = [ job.scratch.tempName(".tif") for s in shards ]
+
+        def evaluate(i):
+            rpool.call(sessions[i],"accessr.isochrone.shard",networkfile,
+                       coords[shards[i],0],coords[shards[i],1],shardfiles[i])
+            return len(shards[i])
+
+        client.updateStatus("Evaluating %d points in %d shards"%(len(coords),len(shards)))
+        threads = ThreadPool(len(shards))
+        try:
+            done = 0
+            for count in threads.imap_unordered(evaluate,range(len(shards))):
+                done += count
+                client.updateStatus("Evaluated %d of %d points"%(done,len(coords)))
+        finally:
+            threads.close()
+            threads.join()
+    finally:
+        for conn in sessions[1:]:
+            pool.release(conn)
+
+    rpool.call(job.R,"accessr.isochrone.merge",shardfiles)
+
+def ReportPoints(client,namespace,total,off_map,na_cells,unique,required=True):
+    """
+    Report points that are off the accessibility map or in NA (barrier)
+    cells, whose results will be empty, and points that share a cell (which
+    is searched only once).  If required, fail when no point is usable.
+    """
+    off_map, na_cells, unique = int(off_map), int(na_cells), int(unique)
+    if off_map:
+        client.updateStatus("%d of %d %s are outside the accessibility map; their results will be empty."%
+                            (off_map,total,namespace))
+    if na_cells:
+        client.updateStatus("%d of %d %s are in inaccessible (NA) cells; their results will be empty."%
+                            (na_cells,total,namespace))
+    usable = total - off_map - na_cells
+    if unique < usable:
+        client.updateStatus("%d %s fall in %d distinct cells; each cell is searched once."%
+                            (usable,namespace,unique))
+    if required and not unique:
+        raise Exception("None of the %s are on accessible cells of the accessibility map"%(namespace,))
+
+def GdistanceNetwork(job,client,rasterfile,points,loaded=False,shared=False):
+    """
+    Load the map and the points into the job's R session and prepare the
+    gdistance cost network (or reload it from the cache).  If loaded is True,
+    the map in rasterfile is already held in the session.  If shared is True
+    the network is always saved to a file that other sessions can read.
+    Returns the network file name ("" if there is none).
+    """
+    import numpy
 
+    # Prepared cost networks are cached on disk, keyed by the raster contents
+    cache = netcache.getCache()
+    networkfile = ""
+    if cache.disk_bytes > 0:
+        networkfile = cache.path(netcache.rasterKey(rasterfile),".rds")
+    if shared and not networkfile:
+        networkfile = job.scratch.tempName(".rds")   # shards still need to share the network
+
+    job.R.oobCallback = lambda msg, code: client.updateStatus("R: "+msg)
+    # Points in longitude/latitude, straight into R
+    off_map, na_cells, unique = rpool.call(job.R,"accessr.isochrone.load",rasterfile,bool(loaded),
+                                           numpy.array(points.lon),numpy.array(points.lat))
+    ReportPoints(client,"points",len(points),off_map,na_cells,unique)
+    rpool.call(job.R,"accessr.isochrone.network",networkfile)
+    if networkfile:
+        cache.touch(networkfile)        # mark as recently used
+        cache.evictDisk()
+    return networkfile
+
+def GdistanceIsochrones(job,client,rasterfile,points,outputfile,per_point,max_cost,workers,loaded=False):
+    """
+    Compute isochrone bands in R with gdistance.  If loaded is True, the map
+    in rasterfile is already held in the job's R session.
+    """
+    datatype, tiffoptions = geotiff.rasterOptions(job.getParameters('isochrone_output'))
+
+    sharded = per_point and workers > 1
+    networkfile = GdistanceNetwork(job,client,rasterfile,points,loaded,sharded)
+    if sharded:
+        with job.stages.stage("accCost"):
+            ShardedEvaluation(job,client,networkfile,workers)
+    else:
+        rpool.call(job.R,"accessr.isochrone.evaluate",bool(per_point))
+    if per_point:
+        rpool.call(job.R,"accessr.isochrone.fan.out")
+    rpool.call(job.R,"accessr.isochrone.write",outputfile,bool(per_point),
+               max_cost or 0,datatype,tiffoptions)     # 0 for no cost limit
+
+def GdistanceODMatrix(job,client,rasterfile,points,destinations,max_cost,workers,loaded=False):
+    """
+    Origin-destination cost matrix in R with gdistance (costDistance), with
+    NaN where a destination cannot be reached.  gdistance evaluates all the
+    pairs in one call, so workers is not used.
+    """
+    import numpy
+
+    GdistanceNetwork(job,client,rasterfile,points,loaded)
+    if destinations:
+        # Checked before any costs are computed
+        off_map, na_cells, unique = rpool.call(job.R,"accessr.od.destinations",
+                                               numpy.array(destinations.lon),numpy.array(destinations.lat))
+        ReportPoints(client,"destinations",len(destinations),off_map,na_cells,unique)
+    costs = rpool.call(job.R,"accessr.od.costs",bool(destinations),max_cost or 0)
+    norigins = len(points)
+    ndestinations = len(destinations or points)
+    costs = numpy.atleast_1d(numpy.asarray(costs,dtype=numpy.float64))
+    return costs.reshape((norigins,ndestinations),order="F")    # R matrices are column-major
+
+def NativeCells(client,grid,points,namespace="points",required=True):
+    """
+    Grid cells of a set of points (a pointfile.PointSet) to search from, -1
+    for points off the raster or in NA cells (see ReportPoints).
+    """
+    import numpy
+    x, y = grid.transformPoints(points.lon,points.lat)
+    cells = grid.cellFromXY(x,y)
+    off_map = cells < 0
+    na_cell = numpy.zeros(len(cells),dtype=bool)
+    na_cell[~off_map] = numpy.isnan(grid.values.flat[cells[~off_map]])
+    cells[na_cell] = -1
+    ReportPoints(client,namespace,len(cells),off_map.sum(),na_cell.sum(),
+                 len(numpy.unique(cells[cells>=0])),required)
+    return cells
+
+def NativeNetwork(job,client,rasterfile,points,loaded=False):
+    """
+    Read the map and locate the points for the native engine, and prepare
+    its cost network (or reload it from the cache).  If loaded is True, the
+    map is taken from the job's R session as raw values instead of being
+    decoded from rasterfile.  Returns the grid, the network and the cells of
+    the points.
+    """
+    import costdistance   # optional dependencies (scipy, GDAL bindings) only needed here
+
+    params = job.getParameters('isochrone_params')
+    block_rows = int(params.get('block_rows',0) or 0)   # build the network in blocks of rows
+
+    with job.stages.stage("read") as stage:
+        grid = exchange.gridFromR(job.R,job.scratch.path) if loaded else costdistance.readGrid(rasterfile)
+        stage.cells = grid.ncell
+    with job.stages.stage("reproject"):
+        cells = NativeCells(client,grid,points)
+    client.updateStatus("Loaded data; starting analysis.")
+
+    # Same raster as an earlier job: reuse its prepared network
+    cache = netcache.getCache()
+    key = netcache.rasterKey(rasterfile)
+    with job.stages.stage("read network",grid.ncell):
+        network = cache.load(key)
+    if network is None:
+        with job.stages.stage("transition",grid.ncell):
+            network = costdistance.costNetwork(grid,block_rows)
+        with job.stages.stage("cache network",grid.ncell):
+            cache.save(key,network)
+        client.updateStatus("Network prep complete; starting evaluation.")
+    else:
+        client.updateStatus("Loaded cached network; starting evaluation.")
+    return grid, network, cells
+
+def NativeIsochrones(job,client,rasterfile,points,outputfile,per_point,max_cost,workers,loaded=False):
+    """
+    Compute isochrone bands in Python with NumPy/SciPy.  If loaded is True,
+    the map is taken from the job's R session rather than read from rasterfile.
+    """
+    import costdistance
+
+    grid, network, cells = NativeNetwork(job,client,rasterfile,points,loaded)
+
+    # Coarse-to-fine evaluation: exact only within exact_radius of the points
+    params = job.getParameters('isochrone_params')
+    near_field = float(params.get('exact_radius',0) or 0)
+    factor = int(params.get('pyramid_factor',4) or 4)
+    pyramid = None
+    if near_field > 0 and factor > 1 and not ( max_cost and near_field >= max_cost ):
+        with job.stages.stage("pyramid") as stage:
+            pyramid = costdistance.Pyramid(grid,factor,int(params.get('block_rows',0) or 0))
+            stage.cells = pyramid.grid.ncell
+        client.updateStatus("Exact costs within %g; beyond that from a %dx coarser map."%(near_field,factor))
+
+    progress = lambda done, total: client.updateStatus("Evaluated %d of %d points"%(done,total))
+    with job.stages.stage("accCost") as stage:
+        bands = costdistance.isochrones(grid,network,cells,per_point,max_cost,workers,progress,
+                                        pyramid,near_field)
+        stage.cells = bands.size
+    client.updateStatus("analysis complete; writing output.")
+    output   = job.getParameters('isochrone_output')
+    datatype = geotiff.dataType(output)
+    options  = geotiff.creationOptions(output)
+    with job.stages.stage("write",bands.size):
+        if grid.lonlat:
+            costdistance.writeGrid(outputfile,grid,bands,datatype,options)
+        else:
+            # A map kept in a projected working CRS is reprojected only now, for display
+            projected = job.scratch.tempName(".tif")
+            costdistance.writeGrid(projected,grid,bands)
+            costdistance.warpToLonLat(projected,outputfile,datatype,options)
+
+def NativeODMatrix(job,client,rasterfile,points,destinations,max_cost,workers,loaded=False):
+    """
+    Origin-destination cost matrix in Python with NumPy/SciPy, with NaN where
+    a destination cannot be reached.  Origins are searched by up to workers
+    processes in parallel.
+    """
+    import costdistance
+
+    grid, network, cells = NativeNetwork(job,client,rasterfile,points,loaded)
+    targets = NativeCells(client,grid,destinations,"destinations") if destinations else cells
+    progress = lambda done, total: client.updateStatus("Evaluated %d of %d origins"%(done,total))
+    with job.stages.stage("accCost") as stage:
+        costs = costdistance.odMatrix(network,cells,targets,max_cost,workers,progress)
+        stage.cells = costs.size
+    return costs
+
+# Isochrone engines: gdistance in Rserve, or the native NumPy/SciPy version
+IsochroneEngines = {
+    "gdistance" : GdistanceIsochrones,
+    "scipy"     : NativeIsochrones,
+    }
+
+# The same engines computing an origin-destination matrix instead
+ODMatrixEngines = {
+    "gdistance" : GdistanceODMatrix,
+    "scipy"     : NativeODMatrix,
+    }
+
+def ReadPoints(job,client,namespace):
+    "Read the points in one of the job's point files (see pointfile.py)"
+    points = pointfile.readPoints(job.datafile(namespace))
+    if points.skipped:
+        client.updateStatus("Skipped %d feature(s) without a location in the %s file."%(points.skipped,namespace))
+    return points
+
+def EvaluationOptions(job):
+    "Engine, cost budget and number of workers from the isochrone_params page"
+    params = job.getParameters('isochrone_params')
+    engine     = params.get('engine','gdistance')
+    if engine not in IsochroneEngines:
+        raise Exception("Unknown Isochrone Engine:",engine)
+    max_cost   = float(params.get('max_cost',0) or 0)         # cost budget (walkshed); 0 for none
+    if max_cost < 0:
+        raise Exception("Maximum cost must not be negative:",max_cost)
+    workers    = max(1,int(params.get('workers',1) or 1))  # parallel shards for per-point bands
+    return engine, max_cost, workers
+
+def ComputeIsochrones(job,client,rasterfile,outputfile,loaded=False,overviews=True):
+    """
+    Compute isochrones on the map in rasterfile for the job's points, using
+    the engine and options on the job's isochrone pages, and write them to
+    outputfile.  loaded is passed on to the engine (see GdistanceIsochrones).
+    Overviews are added if requested, unless overviews is False.  Returns
+    the points (a pointfile.PointSet).
+    """
     # Retrieve job configuration
     # Note: this tool does not use properties of the input files
     output = job.getParameters('isochrone_output')
-
-    # Get the raster accessibility map
-    job.R.r.rasterfile = job.datafile('accessibility') # path to input raster
+    engine, max_cost, workers = EvaluationOptions(job)
+    per_point  = bool(output.get('isochrone_layers',True))  # one band per point, or Destinations only
 
     # Get the points at which to evaluate isochrones
-    points = json.load(file(job.datafile('points')))  # Work around NMTK-R incompatibility
-    for feature in points["features"]:
-        if feature["geometry"]["type"] == "MultiPoint":
-            feature["geometry"]["type"] = "Point"
-            feature["geometry"]["coordinates"] = feature["geometry"]["coordinates"][0]
-    pointfilename = os.tmpnam()+".geojson"
-    ptfile = file(pointfilename,"w")
-    json.dump(points,ptfile)
-    ptfile.close()  # Explicitly close the file (rather than rely on garbage collection)
-                    # so R can open and later delete it reliably
-
-    job.R.r.pointfile  = pointfilename
-    outputfile         = os.tempnam()+".tif"           # Temporary file name for output
-    job.R.r.outfile    = outputfile
-
-    analysis = """
-    require(sp)
-    require(rgdal)
-    require(raster)
-    require(gdistance)
-    r.raster = raster(rasterfile)
-    r.points = readOGR(pointfile,layer="OGRGeoJSON")
-    r.points = spTransform(r.points,projection(r.raster))
-    self.oobSend("Loaded data; starting analysis.")
-
-    # Perform geographic corrections, scaling to X resolution of map
-    # in order to get weighted distances.
-    # Does this work with EPSG:4326?
-    map.unit <- xres(r.raster)
-    tr.func <- function(x) mean(x)*map.unit
-    tr.matrix <- transition(r.raster,tr.func,8)
-    geo.correct <- geoCorrection(tr.matrix,multpl=TRUE)
-    cost.network <- geo.correct * tr.matrix
-    self.oobSend("Network prep complete; starting evaluation.")
-
-    # Use cost.network to compute isochrones from sample points
-    cost <- function(x,y) accCost(cost.network,c(x,y))
-    vcost <- Vectorize(cost,c("x","y"))
-    Isochrones <- brick(vcost(r.points$coords.x1,r.points$coords.x2)) # RasterBrick
-
-    # accCost produces Inf for cells that can't be reached; make those NA
-    values(Isochrones)[which(is.infinite(values(Isochrones)))] <- NA
-    # accCost produces 0 for cells that coincide with Points; make those half the non-zero shortest distance
-    values(Isochrones)[which(values(Isochrones)==0)] <- min(values(Isochrones)[which(values(Isochrones)>0)])/2
-
-    # Scale results for display (probably want to parameterize normalization)
-    # max.isochrone = max(values(Isochrones),na.rm=TRUE)
-    # min.isochrone = min(values(Isochrones),na.rm=TRUE)
-    # self.oobSend(paste("Isochrone min:",min.isochrone,"Isochrone max:",max.isochrone,sep=" "))
-    # Isochrones <- ( Isochrones / max.isochrone ) * 10
-    self.oobSend("analysis complete; writing output.")
-
-    # Summarize individual Isochrones
-    Destinations <- min(Isochrones) # RasterLayer from RasterBrick
-    ResultIsochrones <- brick(list(Destinations,Isochrones))
-
-    writeRaster(ResultIsochrones,filename=outfile,format="GTiff",overwrite=TRUE)
+    points = ReadPoints(job,client,'points')
+    IsochroneEngines[engine](job,client,rasterfile,points,outputfile,
+                             per_point,max_cost,workers,loaded)
+
+    if overviews:
+        with job.stages.stage("overviews"):
+            geotiff.addOverviews(outputfile,output)  # Cloud-Optimized GeoTIFF, if requested
+    return points
+
+def ComputeODMatrix(job,client,rasterfile,outputfile,loaded=False):
     """
-    job.R.oobCallback = lambda msg, code: client.updateStatus("R: "+msg)
-    job.R.r(analysis,void=True)
+    Compute the travel cost from each of the job's points to each of its
+    destinations (or to each of the points, if no destinations file was
+    given) on the map in rasterfile, and write the matrix to outputfile as
+    CSV: one row per origin, one column per destination, "NA" where the
+    destination cannot be reached (or is beyond the cost budget).
+    """
+    import csv
+
+    engine, max_cost, workers = EvaluationOptions(job)
+    points = ReadPoints(job,client,'points')
+    destinations = None
+    if OptionalInput(job,'destinations'):
+        destinations = ReadPoints(job,client,'destinations')
+    costs = ODMatrixEngines[engine](job,client,rasterfile,points,destinations,
+                                    max_cost,workers,loaded)
+
+    client.updateStatus("analysis complete; writing output.")
+    with job.stages.stage("write",costs.size):
+        outfile = file(outputfile,"wb")
+        writer = csv.writer(outfile)
+        writer.writerow(["origin"]+(destinations or points).labels)
+        for label, row in zip(points.labels,costs):
+            writer.writerow([label]+[ "NA" if cost != cost else "%.10g"%(cost,) for cost in row ])
+        outfile.close()
+
+def Evaluate(job,client,rasterfile,loaded=False):
+    """
+    Run the evaluation chosen on the isochrone_output page (isochrone raster,
+    origin-destination matrix or contour polygons) on the map in rasterfile.  Returns the
+    result key and the (file name, open file, content type) for the results.
+    """
+    output = job.getParameters('isochrone_output')
+    geotiff.dataType(output,geotiff.CostDataTypes)     # travel costs do not fit in Int16
+    mode = output.get('output_mode','Isochrones') or 'Isochrones'
+    basename = output.get('isochronefile','Isochrone')
+    if mode == "Isochrones":
+        outputfile = job.scratch.tempName(".tif")            # Temporary file name for output
+        ComputeIsochrones(job,client,rasterfile,outputfile,loaded)
+        return "Isochrone", ( basename+".tif", open(outputfile,"rb"), "image/tiff" )
+    elif mode == "OD Matrix":
+        outputfile = job.scratch.tempName(".csv")
+        ComputeODMatrix(job,client,rasterfile,outputfile,loaded)
+        return "ODMatrix", ( basename+".csv", open(outputfile,"rb"), "text/csv" )
+    elif mode == "Contours":
+        # Contour polygons at the cost breaks, from an intermediate isochrone raster
+        breaks = contours.parseBreaks(output.get('contour_breaks',""))     # None: from the costs reached
+        tolerance = float(output.get('contour_tolerance',0) or 0)
+        isochronefile = job.scratch.tempName(".tif")
+        points = ComputeIsochrones(job,client,rasterfile,isochronefile,loaded,overviews=False)
+        labels = points.labels if output.get('isochrone_layers',True) else None     # per-point bands
+        outputfile = job.scratch.tempName(".geojson")
+        with job.stages.stage("contours"):
+            count, breaks = contours.writeIsochronePolygons(isochronefile,outputfile,breaks,labels,tolerance)
+        client.updateStatus("Wrote %d contour polygons at costs %s."%(count,", ".join("%g"%(b,) for b in breaks)))
+        return "Contours", ( basename+".geojson", open(outputfile,"rb"), "application/json" )
+    else:
+        raise Exception("Unknown Output Mode:",mode)
+
+def DoAccess2(job,client):
+    "Compute isochrones (or an OD cost matrix) on an accessibility map from a set of points"
+
+    # Results are streamed to the NMTK, then closed by performModel
+    outputkey, outputdata = Evaluate(job,client,job.datafile('accessibility'))
+
+    results = {}
+    results["result_file"] = outputkey
+    results["files"]       = { outputkey : outputdata }
+    return results
+
+def DoPipeline(job,client):
+    """
+    Build an accessibility map from a study area and overlay layers and
+    compute isochrones on it, all in one job.  The map stays in the job's R
+    session between the steps rather than going out to the NMTK and back as
+    a GeoTIFF; only the finished map and the isochrones are returned.
+    """
+
+    # Retrieve job configuration
+    layers = OverlayLayers(job,required=False)
+    accessibility_output = job.getParameters('accessibility_output')
+
+    # Base layer (as Access0), kept in memory
+    RasterizeStudyArea(job,client)
+    client.updateStatus("Rasterized study area; applying %d overlay layer(s)."%(len(layers),))
+
+    # Overlays (as Access1), then write the finished accessibility map
+    rpool.call(job.R,"accessr.overlay.from.studyarea")
+    ApplyOverlays(job,client,layers)
+    accessibilityfile = job.scratch.tempName(".tif")
+    datatype, tiffoptions = geotiff.rasterOptions(accessibility_output)
+    rpool.call(job.R,"accessr.overlay.write",accessibilityfile,
+               bool(accessibility_output.get('keep_crs',False)),datatype,tiffoptions)
+    with job.stages.stage("overviews"):
+        geotiff.addOverviews(accessibilityfile,accessibility_output)
+
+    # Isochrones or OD matrix (as Access2) on the map still held in R (the
+    # written map is the job's map in R from now on).  If the map was written
+    # with a lossy data type, use the written map file instead, so that the
+    # results match running Access2 on the returned map.
+    loaded = geotiff.dataType(accessibility_output) == "Float64"
+    outputkey, outputdata = Evaluate(job,client,accessibilityfile,loaded)
 
     # Prepare results
-    if os.path.exists(pointfilename):      # File exists, so we should clean it up
-        job.tempfiles.append(pointfilename)
-    if os.path.exists(outputfile):
-        job.tempfiles.append(outputfile)
-    outputdata     = open(outputfile,"rb")
-    resultfilename = output.get('isochronefile','Isochrone')+".tif"
-    outputkey = "Isochrone"
-    outfiles       = { outputkey : ( resultfilename, outputdata.read(),"image/tiff" ) }
-    outputdata.close()
+    outfiles = {
+        "Accessibility" : ( accessibility_output.get('accessibilityfile','Accessibility')+".tif",
+                            open(accessibilityfile,"rb"),"image/tiff" ),
+        outputkey       : outputdata,
+        }
 
     results = {}
     results["result_file"] = outputkey
@@ -255,6 +639,7 @@ doSubTool = {
     "Access0" : DoAccess0,
     "Access1" : DoAccess1,
     "Access2" : DoAccess2,
+    "AccessPipeline" : DoPipeline,
 #    "BugDemo" : BugDemo,
     }
 
@@ -281,14 +666,24 @@ def performModel(input_files,
 
     # AccessR - Dispatch to subtools
     with Config.Job(input_files,tool_config) as job:
+        results = None
         try:
             job.setup()
             job.logger = logger  # in case we need it...
-            job.tempfiles = []
-            job.R = pyRserve.connect()
+            job.scratch = exchange.Scratch()     # job's temporary files, removed as a whole at the end
+            exchange.sweepInBackground(logger)   # folders left behind by crashed workers
+            job.stages = stages.StageLog(logger)
+            job.R = rpool.getPool().acquire()   # pre-warmed: spatial packages already loaded
+            job.stages.startR(job.R)
+            rpool.call(job.R,"accessr.set.tmpdir",job.scratch.path) # raster's own temporary files (tiled mode) go there too
             if subtool_name in doSubTool:
                 results = doSubTool[subtool_name](job,client)
+                job.stages.collectR(job.R)
                 if results:
+                    # Per-stage timings and memory go back with the results
+                    client.updateStatus("Stage timings: "+job.stages.summary())
+                    files = results.setdefault("files",{})
+                    files["metrics"] = ("metrics.json",job.stages.toJSON(),"application/json")
                     client.updateResults(result_field=results.get("field",None),
                                          units=results.get("units",None),
                                          result_file=results.get("result_file",None),
@@ -313,10 +708,16 @@ def performModel(input_files,
                                  files={}
                              )
         finally:
-            if hasattr(job,"tempfiles"):
-                if not hasattr(job,"R"): # low likelihood...
-                    job.R = pyRserve.connect()
-                for file in job.tempfiles:
-                    job.R.r.unlink(file)
-            if hasattr(job,"R")and job.R:
-                job.R.close()
+            # Result files are handed to the client as open file objects so
+            # they can be streamed rather than held in memory; close them now
+            if results and results.get("files"):
+                for entry in results["files"].values():
+                    if hasattr(entry[1],"close"):
+                        entry[1].close()
+            try:
+                if getattr(job,"scratch",None):
+                    job.scratch.remove(getattr(job,"R",None))
+            finally:
+                if getattr(job,"R",None):
+                    rpool.getPool().release(job.R)  # resets the R session for the next job
+                    job.R = None
@@ -15,15 +15,19 @@ will be added to the NMTK when the system is installed, or when you
 run the Django command python manage.py collectstatic.
 """
 
+import resolution
+
 tools = [
     "Access0",
     "Access1",
     "Access2",
+    "AccessPipeline",
 ]
 
 # Access0 prepares a raster base Accessibility layer from a polygon area
 # Access1 adds an accessibility layer from a vector (or compatible raster) file
 # Access2 computes isochrones from an Accessibility layer and a point file
+# AccessPipeline runs all three steps in a single job
 
 # If tool_configs.py contains the generateToolConfiguration function,
 # that will be used preferentially to generate a Python dictionary
@@ -127,6 +131,22 @@ a file of points for which isochrones are computed using the accessibility map.<
                     "type" : "numeric",
                     "value": 300,
                 },
+                "cell_size" : {
+                    "type" : "numeric",
+                    "value": 0,
+                },
+                "max_cells" : {
+                    "type" : "numeric",
+                    "value": 0,
+                },
+                "working_epsg" : {
+                    "type" : "numeric",
+                    "value": 4326,
+                },
+                "block_rows" : {
+                    "type" : "numeric",
+                    "value": 0,
+                },
             },
             "studyarea_output" : {
                 "studyareafile" : {
@@ -190,6 +210,57 @@ These parameters will be used by subsequent Accessibility steps (Overlay and Eva
                   "type" : "numeric",
                   "name" : "raster_y"
               },
+              {
+                  "description" : """
+Size of the (square) cells in metres.  If set, the number of X and Y cells is chosen from the
+size of the study area and the X Cells and Y Cells settings are ignored.  Use 0 for fixed
+X and Y cells.
+""",
+                  "default" : 0,
+                  "required" : False,
+                  "label" : "Cell Size (metres)",
+                  "type" : "numeric",
+                  "name" : "cell_size"
+              },
+              {
+                  "description" : """
+Maximum number of cells in the map.  Used alone, the map gets the finest square cells that fit
+the budget; with a cell size or fixed X and Y cells, the grid is made coarser if needed to fit.
+Use 0 for no limit.  The number of cells drives the time taken by the Evaluation step; the job
+status reports an estimate for the chosen grid.  Rough guide:
+"""+resolution.costGuide()+"""
+""",
+                  "default" : 0,
+                  "required" : False,
+                  "label" : "Cell Budget",
+                  "type" : "numeric",
+                  "name" : "max_cells"
+              },
+              {
+                  "description" : """
+EPSG code of the coordinate system for the accessibility map.  The default (4326, longitude
+and latitude) displays directly in the NMTK.  A projected coordinate system (e.g. a UTM zone)
+can be kept through the Overlay steps to avoid resampling the map, and is reprojected only
+for display when isochrones are computed.
+""",
+                  "default" : 4326,
+                  "required" : False,
+                  "label" : "Working Coordinate System (EPSG)",
+                  "type" : "numeric",
+                  "name" : "working_epsg"
+              },
+              {
+                  "description" : """
+For very large grids, process the raster on disk in blocks of this many rows so that memory
+use is bounded by the block size rather than the size of the map.  Use 0 to process the
+whole raster in memory (fastest for ordinary grids).
+""",
+                  "default" : 0,
+                  "required" : False,
+                  "label" : "Block Rows (tiled processing)",
+                  "type" : "numeric",
+                  "name" : "block_rows"
+              },
               ],
             },
         ],
@@ -258,7 +329,8 @@ update are provided: "Barriers" are areas that will be considered completely
 untraversable or off-limits.  Areas occupied by barriers will be considered outside
 the analysis area.  "Obstacles" simply reduce the base accessibility by the
 accessibility value but still allow passage.  "Facilities" increase the base
-accessibility.</LI>
+accessibility.  Up to six overlay layers, each with its own style, can be applied in
+order in a single run of this tool.</LI>
 
 <LI>The third step accepts an accessibility map from one of the previous steps, plus
 a file of points for which isochrones are computed using the accessibility map.</LI>
@@ -293,11 +365,21 @@ a file of points for which isochrones are computed using the accessibility map.<
                     "value": "Facility",
                 },
             },
+            "processing_params": {
+                "block_rows" : {
+                    "type" : "numeric",
+                    "value": 0,
+                },
+            },
             "accessibility_output" : {
                 "accessibilityfile" : {
                     "type":"string",
                     "value":"Accessibility",
                 },
+                "keep_crs" : {
+                    "type":"boolean",
+                    "value":False,
+                },
             },
         },
     },
@@ -371,6 +453,31 @@ reduce accessibility, or as Facilities that increase accessibility.  The Accessi
                   },
               ],
           },
+          {
+            "type" : "ConfigurationPage",
+            "name" : "processing_params",
+            "namespace" : "processing_params",
+            "description" :
+"""
+Parameters that control how the overlay is processed.
+""",
+            "label" : "Processing Parameters",
+            "expanded" : False,
+            "elements" : [
+              {
+                  "description" : """
+For very large grids, process the raster on disk in blocks of this many rows so that memory
+use is bounded by the block size rather than the size of the map.  Use 0 to process the
+whole raster in memory (fastest for ordinary grids).
+""",
+                  "default" : 0,
+                  "required" : False,
+                  "label" : "Block Rows (tiled processing)",
+                  "type" : "numeric",
+                  "name" : "block_rows"
+              },
+              ],
+          },
         ],
     "output" : [
             {
@@ -392,11 +499,67 @@ Change the default name for the Accessibility layer.
                   "type":"string",
                   "name":"accessibilityfile",
                 },
+                {
+            "description":"""
+Keep the accessibility map in its current (projected) coordinate system instead of reprojecting
+it to longitude/latitude for display.  Maps already in longitude/latitude are never reprojected.
+""",
+                  "default":False,
+                  "required":False,
+                  "label":"Keep Working Coordinate System",
+                  "type":"boolean",
+                  "name":"keep_crs",
+                },
               ],
            },
         ],
     }
 
+# Access1 can apply several overlay layers in one job (as in the workflow in
+# doaccessibility.R).  Layers 2 and up are optional files with the same
+# elements as "overlay", plus their own overlay style on the Overlay Type page.
+MaxOverlays = 6
+overlay_type = [ page for page in Access1["input"] if page["name"] == "overlay_type" ][0]
+for n in range(2,MaxOverlays+1):
+    Access1["input"].insert(n,
+        {
+            "type" : "File",
+            "name" : "overlay%d"%(n,),
+            "namespace" : "overlay%d"%(n,),
+            "description" :
+"""
+Optional additional overlay layer %d, applied after the previous layers in the same job
+"""%(n,),
+            "primary" : False,
+            "required" : False,
+            "label" : "Overlay layer %d (optional)"%(n,),
+            "spatial_types" : ["POLYGON","POINT","LINE"],
+            "elements" :
+                [
+                    {
+                        "description" : """
+The value to be assigned to raster cells coinciding with each feature.  May be a constant or a file property.
+""",
+                        "default" : 6,
+                        "label" : "Accessibility",
+                        "type" : "number",
+                        "name" : "accessibility"
+                    },
+                ],
+        })
+    overlay_type["elements"].append(
+        {
+            "description":"""
+Overlay style for optional overlay layer %d (Barrier, Obstacle or Facility).
+"""%(n,),
+            "default":"Facility",
+            "required":False,
+            "label":"Overlay Style (layer %d)"%(n,),
+            "type":"string",
+            "choices":["Barrier","Obstacle","Facility"],
+            "name":"overlay_style%d"%(n,),
+        })
+
 # Access2 : Compute isochrones on an Accessibilty layer from a set of points
 Access2 = {
     "info" : {
@@ -461,11 +624,45 @@ a file of points for which isochrones are computed using the accessibility map.<
             },
         ],
         "config" : {
+            "isochrone_params" : {
+                "engine" : {
+                    "type" : "string",
+                    "value" : "gdistance",
+                },
+                "max_cost" : {
+                    "type" : "numeric",
+                    "value" : 0,
+                },
+                "workers" : {
+                    "type" : "numeric",
+                    "value" : 1,
+                },
+                "block_rows" : {
+                    "type" : "numeric",
+                    "value" : 0,
+                },
+                "exact_radius" : {
+                    "type" : "numeric",
+                    "value" : 0,
+                },
+                "pyramid_factor" : {
+                    "type" : "numeric",
+                    "value" : 4,
+                },
+            },
             "isochrone_output" : {
                 "isochronefile" : {
                     "type" : "string",
                     "value" : "Isochrone",
-                }
+                },
+                "isochrone_layers" : {
+                    "type" : "boolean",
+                    "value" : True,
+                },
+                "output_mode" : {
+                    "type" : "string",
+                    "value" : "Isochrones",
+                },
             },  
         },
     },
@@ -497,6 +694,105 @@ Spatial data file at which to evaluate Accessibility
             "label" : "Points at which to evaluate accessibility",
             "spatial_types" : ["POINT"], # require specific spatial types
         },
+        {
+            "type" : "File",
+            "name" : "destinations",
+            "namespace" : "destinations",
+            "description" :
+"""
+Optional destination points for the OD Matrix output.  Without this file, the matrix gives the cost
+between every pair of the points above.
+""",
+            "primary" : False,
+            "required" : False,
+            "label" : "Destinations for the OD Matrix (optional)",
+            "spatial_types" : ["POINT"],
+        },
+        {
+            "type" : "ConfigurationPage",
+            "name" : "isochrone_params",
+            "namespace" : "isochrone_params",
+            "description" :
+"""
+Parameters that control how the isochrones are computed.
+""",
+            "label" : "Evaluation Parameters",
+            "expanded" : False,
+            "elements" : [
+              {
+                  "description" : """
+Engine used to compute the isochrones.  "gdistance" runs the analysis in R; "scipy" computes
+the same cost-distance surfaces directly in Python (NumPy/SciPy) and is usually faster.
+""",
+                  "default" : "gdistance",
+                  "required" : True,
+                  "label" : "Isochrone Engine",
+                  "type" : "string",
+                  "choices" : ["gdistance","scipy"],
+                  "name" : "engine"
+              },
+              {
+                  "description" : """
+Maximum travel cost (for example, a walkshed budget) to include in the isochrones.  Cells that
+cost more than this to reach are left empty.  With the "scipy" engine the search stops expanding
+at this budget, so a small budget on a large map runs much faster.  Use 0 for no limit.
+""",
+                  "default" : 0,
+                  "required" : False,
+                  "label" : "Maximum Cost",
+                  "type" : "numeric",
+                  "name" : "max_cost"
+              },
+              {
+                  "description" : """
+Number of parallel workers used to compute the individual isochrone bands.  The points are split
+into that many shards.  The "gdistance" engine runs each shard in its own Rserve session (limited
+by the number of pooled sessions); the "scipy" engine uses worker processes.
+""",
+                  "default" : 1,
+                  "required" : False,
+                  "label" : "Parallel Workers",
+                  "type" : "numeric",
+                  "name" : "workers"
+              },
+              {
+                  "description" : """
+For very large grids with the "scipy" engine, build the cost network this many rows at a time,
+which bounds the temporary memory needed while it is prepared.  Use 0 to build it in one pass.
+(The "gdistance" engine always prepares the whole network at once.)
+""",
+                  "default" : 0,
+                  "required" : False,
+                  "label" : "Block Rows (tiled processing)",
+                  "type" : "numeric",
+                  "name" : "block_rows"
+              },
+              {
+                  "description" : """
+Coarse-to-fine evaluation for large maps with the "scipy" engine: costs up to this radius from
+each point are computed exactly at full resolution, and costs beyond it are filled in from a
+coarse copy of the map (see Coarse Factor).  A smaller radius is faster but less accurate far
+from the points, where costs come out somewhat low.  Use 0 to compute every cell exactly.
+""",
+                  "default" : 0,
+                  "required" : False,
+                  "label" : "Exact Radius (cost)",
+                  "type" : "numeric",
+                  "name" : "exact_radius"
+              },
+              {
+                  "description" : """
+Size of the blocks of cells (factor x factor) that make up each cell of the coarse map used
+beyond the Exact Radius.
+""",
+                  "default" : 4,
+                  "required" : False,
+                  "label" : "Coarse Factor",
+                  "type" : "numeric",
+                  "name" : "pyramid_factor"
+              },
+              ],
+        },
     ],
     "output" : [
             {
@@ -518,11 +814,170 @@ Change the default name for the Accessibility layer.
                   "type":"string",
                   "name":"isochronefile",
                 },
+                {
+            "description":"""
+Include a separate isochrone band for each point after the combined Destinations band.  If this
+is turned off, only the Destinations band (travel cost to the nearest point) is produced, which
+is computed in a single pass over the map and is much faster for large point files.
+""",
+                  "default":True,
+                  "required":False,
+                  "label":"Isochrone for Each Point",
+                  "type":"boolean",
+                  "name":"isochrone_layers",
+                },
+                {
+            "description":"""
+"Isochrones" returns the isochrone raster.  "OD Matrix" instead returns a CSV table of the travel
+cost from each point (rows) to each destination (columns), or between every pair of points if no
+destinations file is given; no raster bands are computed, so this is much faster for scoring.
+Unreachable pairs, and pairs beyond the Maximum Cost, are NA.  "Contours" returns simplified
+isochrone polygons (GeoJSON) at the Contour Breaks, for the Destinations band and, if Isochrone
+for Each Point is on, for each point; this is much smaller than the raster and quicker to display.
+""",
+                  "default":"Isochrones",
+                  "required":False,
+                  "label":"Output Mode",
+                  "type":"string",
+                  "choices":["Isochrones","OD Matrix","Contours"],
+                  "name":"output_mode",
+                },
+                {
+            "description":"""
+Costs at which to draw the isochrone contours (Contours output mode), separated by commas.  Each
+polygon covers the cells that cost more than the previous break and no more than its own.  Leave
+empty to use the quartiles of the costs reached (costs are in map units, often thousands per cell
+on longitude/latitude maps).
+""",
+                  "default":"",
+                  "required":False,
+                  "label":"Contour Breaks",
+                  "type":"string",
+                  "name":"contour_breaks",
+                },
+                {
+            "description":"""
+Simplification tolerance for the contour polygons, in degrees.  Use 0 for half a raster cell.
+""",
+                  "default":0,
+                  "required":False,
+                  "label":"Contour Simplification",
+                  "type":"numeric",
+                  "name":"contour_tolerance",
+                },
               ],
             },
         ],
     }
 
+# GeoTIFF format options, shared by the output pages of all three subtools
+# (see geotiff.py for how they are applied).
+OutputFormatElements = [
+    {
+        "description":"""
+Data type for the output raster.  Float64 is exact; Float32 halves the file size with ample
+precision for accessibility values and travel costs; Int16 is smaller still but rounds values to
+whole numbers (and cannot hold values above 32767).
+""",
+        "default":"Float64",
+        "required":False,
+        "label":"Output Data Type",
+        "type":"string",
+        "choices":["Float64","Float32","Int16"],
+        "name":"datatype",
+    },
+    {
+        "description":"""
+Compression for the output raster.  DEFLATE usually gives the smallest files; LZW is faster to
+write.  Both are lossless.
+""",
+        "default":"None",
+        "required":False,
+        "label":"Output Compression",
+        "type":"string",
+        "choices":["None","DEFLATE","LZW"],
+        "name":"compression",
+    },
+    {
+        "description":"""
+Store the output raster in 256x256 internal tiles rather than strips, which is faster to display.
+""",
+        "default":False,
+        "required":False,
+        "label":"Tiled Output",
+        "type":"boolean",
+        "name":"tiled",
+    },
+    {
+        "description":"""
+Add reduced-resolution overviews and write the output as a Cloud-Optimized GeoTIFF, so that
+large rasters display quickly in the map viewer.
+""",
+        "default":False,
+        "required":False,
+        "label":"Add Overviews",
+        "type":"boolean",
+        "name":"overviews",
+    },
+]
+import copy
+for config in (Access0,Access1,Access2):
+    config["output"][0]["elements"].extend(copy.deepcopy(OutputFormatElements))
+
+# Accumulated travel costs run far past the range of Int16 (or round to 0 on
+# projected maps), so isochrones are floating point only
+_datatype = [ e for e in Access2["output"][0]["elements"] if e["name"] == "datatype" ][0]
+_datatype["choices"] = ["Float64","Float32"]
+_datatype["description"] = """
+Data type for the output raster.  Float64 is exact; Float32 halves the file size with ample
+precision for travel costs.
+"""
+
+# AccessPipeline : all three steps in one job, assembled from the pages of the
+# other subtools.  The accessibility map is kept in memory between the steps.
+def _page(config,name):
+    return copy.deepcopy([ page for page in config["input"]+config["output"] if page["name"] == name ][0])
+
+AccessPipeline = {
+    "info" : {
+        "name" : "Accessibility: Pipeline",
+        "version" : "0.1",
+        "text" :
+"""
+<P>The Accessibility: Pipeline tool runs the three Accessibility steps in a single job:
+it rasterizes a study area (as Accessibility: Base Layer), applies up to six overlay
+layers of barriers, obstacles and facilities (as Accessibility: Overlay) and computes
+isochrones from a set of points (as Accessibility: Evaluation).</P>
+
+<P>The accessibility map is kept in memory from one step to the next rather than being
+written out and loaded again, so the whole analysis runs considerably faster than the
+three separate tools.  Both the finished accessibility map and the isochrones are
+returned.  Use the separate tools instead when you want to inspect or reuse the
+intermediate maps.</P>
+""",
+        },
+    "sample" : {
+        "files" : [ copy.deepcopy(f) for f in Access0["sample"]["files"] if f["namespace"] == "rasterize" ] +
+                  [ copy.deepcopy(f) for f in Access1["sample"]["files"] if f["namespace"] == "overlay" ] +
+                  [ copy.deepcopy(f) for f in Access2["sample"]["files"] if f["namespace"] == "points" ],
+        "config" : dict( [ (name,copy.deepcopy(Access0["sample"]["config"][name]))
+                           for name in ("rasterize","rasterization_params") ] +
+                         [ (name,copy.deepcopy(Access1["sample"]["config"][name]))
+                           for name in ("overlay","overlay_type","accessibility_output") ] +
+                         [ (name,copy.deepcopy(Access2["sample"]["config"][name]))
+                           for name in ("isochrone_params","isochrone_output") ] ),
+        },
+    "input" : [ _page(Access0,"rasterize"), _page(Access0,"rasterization_params") ] +
+              [ _page(Access1,name) for name in ["overlay"]+[ "overlay%d"%(n,) for n in range(2,MaxOverlays+1) ] ] +
+              [ _page(Access1,"overlay_type") ] +
+              [ _page(Access2,name) for name in ("points","destinations","isochrone_params") ],
+    "output" : [ _page(Access1,"accessibility_output"), _page(Access2,"isochrone_output") ],
+    }
+# In the pipeline the overlays are optional and the points are required
+[ page for page in AccessPipeline["input"] if page["name"] == "overlay" ][0]["required"] = False
+[ page for page in AccessPipeline["input"] if page["name"] == "points" ][0]["required"] = True
+[ page for page in AccessPipeline["output"] if page["name"] == "isochrone_output" ][0]["label"] = "Isochrone Output"
+
 # Expect this to be an array with a config dictionary name in it if no subtools; otherwise
 # it's a dictionary with the key being the subtool name (from the "tools" array) and the
 # value being the dictionary that actually contains the tool config.
@@ -530,6 +985,7 @@ tool_configs = {
     "Access0" : Access0,
     "Access1" : Access1,
     "Access2" : Access2,
+    "AccessPipeline" : AccessPipeline,
 }
 
 # Here's a simple function that you can use to dump the tool